@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Runs deploy, zdt_deploy, wave_deploy (in waves of 5), init,
+update_environments and gc_versions (of 1200 versions) against
+the simulator (benchmarks/simulator.py) for a range of environment
+counts and archive sizes and reports wall clock time, aws api
+calls and peak memory for each.  gc_versions fails unless the
+versions left are exactly the ones it should keep.
+
+    > python benchmarks/deploy.py --environments 1 5 20 --archive-mb 1 25
+
+Environments take --launch-time/--update-time seconds to
+become Ready and every call takes --latency seconds, so the
+wall clock time mostly shows how well commands overlap and
+poll.  Peak memory is measured with tracemalloc, which slows
+the archive build down a little.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from time import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ebs_deploy import EbsHelper  # noqa: E402
+from ebs_deploy.cli import Session, main  # noqa: E402
+from simulator import Simulator  # noqa: E402
+
+APP_NAME = 'Benchmark'
+BUCKET = 'benchmark-bucket'
+FILE_SIZE = 256 * 1024
+VERSIONS_TO_KEEP = 5
+GC_VERSIONS = 1200
+
+CONFIG = """
+aws:
+    access_key: 'benchmark'
+    secret_key: 'benchmark'
+    region: 'us-west-2'
+    bucket: '""" + BUCKET + """'
+    bucket_path: 'benchmark'
+
+cache:
+    enabled: false
+
+poll:
+    initial_delay: 0.05
+    min_interval: 0.05
+    max_interval: 0.25
+
+app:
+    app_name: '""" + APP_NAME + """'
+    versions_to_keep: """ + str(VERSIONS_TO_KEEP) + """
+    gc:
+        rate: 1000
+        workers: 8
+    all_environments:
+        solution_stack_name: '64bit Amazon Linux 2018.03 v2.7.0 running Python 3.6'
+        archive:
+            workers: 4
+            upload:
+                multipart_threshold_mb: %(multipart_threshold_mb)s
+                part_size_mb: 5
+        option_settings:
+            'aws:autoscaling:asg':
+                MinSize: 1
+                MaxSize: 5
+    environments:
+%(environments)s
+"""
+
+
+class SimulatedSession(Session):
+    """
+    Session whose helpers talk to the simulator
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self.helpers = []
+
+    def metadata_cache(self, filename, ttl, refresh):
+        return None
+
+    def helper(self, aws, app_name, wait_time_secs, cache, poll_schedule, health_rules):
+        helper = EbsHelper(aws, app_name=app_name, wait_time_secs=wait_time_secs, cache=cache,
+                           poll_schedule=poll_schedule, health_rules=health_rules, connections=self.simulator)
+        self.helpers.append(helper)
+        return helper
+
+
+def env_name(i):
+    return 'Benchmark-' + str(i)
+
+
+def write_project(directory, environments, archive_mb, multipart_threshold_mb):
+    """
+    Writes the config and archive_mb of incompressible files
+    """
+    env_lines = []
+    for i in range(environments):
+        env_lines.append("        '" + env_name(i) + "':\n            cname_prefix: 'benchmark-" + str(i) + "'")
+    with open(os.path.join(directory, 'ebs.config'), 'w') as f:
+        f.write(CONFIG % {'environments': "\n".join(env_lines), 'multipart_threshold_mb': multipart_threshold_mb})
+    source = os.path.join(directory, 'src')
+    os.makedirs(source)
+    remaining = int(archive_mb * 1024 * 1024)
+    i = 0
+    while remaining > 0:
+        with open(os.path.join(source, 'file' + str(i) + '.bin'), 'wb') as f:
+            f.write(os.urandom(min(FILE_SIZE, remaining)))
+        remaining -= FILE_SIZE
+        i += 1
+
+
+def seed(simulator, environments, existing, versions=8, in_use='old-7'):
+    """
+    Sets up the application and versions old-0 (the oldest) to
+    old-<versions - 1>, with its environments running in_use
+    unless existing is false
+    """
+    simulator.add_bucket(BUCKET, 'us-west-2')
+    simulator.add_application(APP_NAME)
+    for i in range(versions):
+        simulator.add_version(APP_NAME, 'old-' + str(i), BUCKET, 'benchmark/old-' + str(i) + '.zip')
+    if existing:
+        for i in range(environments):
+            simulator.add_environment(APP_NAME, env_name(i), 'benchmark-' + str(i), in_use)
+
+
+def check_gc(simulator):
+    """
+    Raises unless exactly versions_to_keep versions are left
+    besides the older ones environments still run
+    """
+    versions = sorted(simulator.versions.values(), key=lambda version: version['DateCreated'], reverse=True)
+    newest = set(version['VersionLabel'] for version in versions[:VERSIONS_TO_KEEP])
+    in_use = set(env['VersionLabel'] for env in simulator.environments.values() if env['Status'] != 'Terminated')
+    expected = VERSIONS_TO_KEEP + len(in_use - newest)
+    if len(versions) != expected:
+        raise Exception("gc_versions left " + str(len(versions)) + " versions, expected " + str(expected))
+
+
+SCENARIOS = [
+    ('deploy', True, lambda environments: ['deploy', '-e', env_name(0), '-d', 'src']),
+    ('zdt_deploy', True, lambda environments: ['zdt_deploy', '-e', env_name(0), '-d', 'src']),
+    ('wave_deploy', True, lambda environments: ['wave_deploy', '-s', '5', '-d', 'src']),
+    ('init', False, lambda environments: ['init', '-p', str(environments)]),
+    ('update_environments', True, lambda environments: ['update_environments', '-p', str(environments)]),
+    ('gc_versions', True, lambda environments: ['gc_versions'])
+]
+
+
+def run(name, argv, environments, archive_mb, args):
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    try:
+        write_project(directory, environments, archive_mb, args.multipart_threshold_mb)
+        simulator = Simulator(launch_time=args.launch_time, update_time=args.update_time,
+                              swap_time=args.swap_time, terminate_time=args.terminate_time,
+                              latency=args.latency, throttle_rate=args.throttle_rate, seed=1)
+        if name == 'gc_versions':
+            # enough versions to page, environments run the oldest
+            seed(simulator, environments, True, versions=GC_VERSIONS, in_use='old-0')
+        else:
+            seed(simulator, environments, name != 'init')
+        session = SimulatedSession(simulator)
+        os.chdir(directory)
+        sys.stdout = open(os.devnull, 'w')
+        tracemalloc.start()
+        started = time()
+        try:
+            main(['ebs-deploy'] + argv, session=session)
+            code = 0
+        except SystemExit as e:
+            code = e.code or 0
+        elapsed = time() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    if code not in (0, None):
+        raise Exception(name + " failed with exit code " + str(code))
+    if name == 'gc_versions':
+        check_gc(simulator)
+    stats = session.helpers[0].api_stats
+    return {'seconds': elapsed, 'calls': stats.total('calls'), 'beanstalk': stats.total('calls', 'beanstalk'),
+            's3': stats.total('calls', 's3'), 'throttles': stats.total('throttles'),
+            'peak_mb': peak / 1024.0 / 1024.0}
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='ebs-deploy deploy benchmarks against a simulated aws')
+    parser.add_argument('-c', '--commands', nargs='+', help='Commands to run',
+                        default=[scenario[0] for scenario in SCENARIOS])
+    parser.add_argument('-e', '--environments', nargs='+', type=int, default=[1, 5, 20],
+                        help='Environment counts')
+    parser.add_argument('-a', '--archive-mb', nargs='+', type=float, default=[1, 25], help='Archive sizes in MB')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every api call takes')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Probability that a call is throttled')
+    parser.add_argument('--launch-time', type=float, default=1.0, help='Seconds environments take to launch')
+    parser.add_argument('--update-time', type=float, default=0.5, help='Seconds environments take to update')
+    parser.add_argument('--swap-time', type=float, default=0.2, help='Seconds a cname swap takes')
+    parser.add_argument('--terminate-time', type=float, default=0.5, help='Seconds environments take to terminate')
+    parser.add_argument('--multipart-threshold-mb', type=int, default=8, help='archive.upload.multipart_threshold_mb')
+    args = parser.parse_args()
+
+    row = "%-20s %5s %9s %9s %7s %10s %5s %10s %9s"
+    print(row % ('command', 'envs', 'archive', 'seconds', 'calls', 'beanstalk', 's3', 'throttled', 'peak MB'))
+    for name, existing, make_argv in SCENARIOS:
+        if name not in args.commands:
+            continue
+        for environments in args.environments:
+            # only the deploys build archives
+            sizes = args.archive_mb if name in ('deploy', 'zdt_deploy', 'wave_deploy') else [0]
+            for archive_mb in sizes:
+                result = run(name, make_argv(environments), environments, archive_mb, args)
+                print(row % (name, environments, str(archive_mb) + ' MB' if archive_mb else '-',
+                             '%.2f' % result['seconds'], result['calls'], result['beanstalk'], result['s3'],
+                             result['throttles'], '%.1f' % result['peak_mb']))
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,694 @@
+"""
+An in process stand in for the Beanstalk and S3 apis that
+EbsHelper uses, for the benchmarks, the tests and trying
+things out without an aws account:
+
+    simulator = Simulator(launch_time=2, latency=0.05)
+    helper = EbsHelper(aws, 300, app_name='App', connections=simulator)
+
+Environments move through Launching/Updating/Terminating to
+Ready/Terminated after the configured times, raising events
+on the way, and calls can be slowed down or throttled.  S3
+only keeps the size, md5 and metadata of what's uploaded.
+Errors are raised as boto's exceptions so boto is still
+needed.
+"""
+
+import hashlib
+import json
+import random
+import threading
+from time import time, sleep
+
+from ebs_deploy import parse_timestamp
+
+SOLUTION_STACKS = [
+    '64bit Amazon Linux 2018.03 v2.7.0 running Python 3.6',
+    '64bit Amazon Linux 2018.03 v2.8.0 running Java 8',
+    '64bit Amazon Linux 2018.03 v4.5.0 running Node.js'
+]
+EVENT_PAGE_SIZE = 100
+LIST_PAGE_SIZE = 1000
+
+
+def _response(action, result):
+    return {action + 'Response': {action + 'Result': result, 'ResponseMetadata': {'RequestId': 'simulated'}}}
+
+
+class Simulator(object):
+    """
+    The simulated aws account, connections are opened with
+    connect_beanstalk(aws) and connect_s3(aws) (EbsHelper's
+    connections argument).  Times are in seconds:
+
+    launch_time, update_time, swap_time, terminate_time - how
+        long environments take to create (or rebuild), update,
+        swap cnames and terminate
+    health - the health environments end up in, set_health()
+        changes it for a single environment
+    latency - time every call takes, a number or a dict of
+        operation name to number (missing ones take 0)
+    throttle_rate - probability that a call is throttled
+    max_calls_per_second - calls beyond this rate (per service,
+        over a one second window) are throttled
+    """
+
+    def __init__(self, launch_time=1.0, update_time=0.5, swap_time=0.2, terminate_time=0.5, health='Green',
+                 latency=0.0, throttle_rate=0.0, max_calls_per_second=None, seed=None):
+        self.launch_time = launch_time
+        self.update_time = update_time
+        self.swap_time = swap_time
+        self.terminate_time = terminate_time
+        self.health = health
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_calls_per_second = max_calls_per_second
+        self.random = random.Random(seed)
+        self.applications = {}
+        self.versions = {}
+        self.environments = {}
+        self.events = []
+        self.buckets = {}
+        self.calls = {}
+        self.throttled = {}
+        self._health = {}
+        self._recent_calls = {}
+        self._next_id = 0
+        self._lock = threading.RLock()
+
+    def connect_beanstalk(self, aws):
+        return BeanstalkConnection(self)
+
+    def connect_s3(self, aws):
+        return S3Connection(self)
+
+    def add_application(self, application_name):
+        """
+        Adds an application, the add_ methods set up state
+        without making (or counting) calls
+        """
+        with self._lock:
+            self.applications[application_name] = {'ApplicationName': application_name, 'Description': None,
+                                                   'DateCreated': time()}
+
+    def add_version(self, application_name, version_label, s3_bucket=None, s3_key=None, description=None):
+        with self._lock:
+            self.versions[(application_name, version_label)] = {
+                'ApplicationName': application_name, 'VersionLabel': version_label, 'Description': description,
+                'SourceBundle': {'S3Bucket': s3_bucket, 'S3Key': s3_key}, 'DateCreated': time(),
+                'DateUpdated': time()}
+
+    def add_environment(self, application_name, env_name, cname_prefix=None, version_label=None,
+                        solution_stack_name=SOLUTION_STACKS[0]):
+        """
+        Adds a Ready environment
+        """
+        with self._lock:
+            self.environments[env_name] = {
+                'EnvironmentName': env_name, 'EnvironmentId': self._id('e-'), 'ApplicationName': application_name,
+                'VersionLabel': version_label, 'SolutionStackName': solution_stack_name, 'Description': None,
+                'CNAME': (cname_prefix or env_name).lower() + '.elasticbeanstalk.com',
+                'Tier': {'Name': 'WebServer', 'Type': 'Standard', 'Version': '1.0'},
+                'DateCreated': time(), 'DateUpdated': time(), 'Status': 'Ready',
+                'Health': self._health.get(env_name, self.health)}
+
+    def add_bucket(self, bucket_name, location=''):
+        with self._lock:
+            self.buckets.setdefault(bucket_name, {'location': location, 'keys': {}, 'uploads': {}})
+
+    def set_health(self, env_name, health):
+        """
+        Sets the health an environment ends up in after its
+        current (and any later) transition
+        """
+        with self._lock:
+            self._health[env_name] = health
+            env = self.environments.get(env_name)
+            if env is not None and 'transition' not in env:
+                env['Health'] = health
+
+    def _id(self, prefix):
+        with self._lock:
+            self._next_id += 1
+            return prefix + str(self._next_id)
+
+    def call(self, service, operation):
+        """
+        Accounts for a call, sleeps for its latency and returns
+        whether it was throttled
+        """
+        latency = self.latency.get(operation, 0) if isinstance(self.latency, dict) else self.latency
+        if latency:
+            sleep(latency)
+        now = time()
+        with self._lock:
+            key = (service, operation)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+            if self.max_calls_per_second:
+                recent = [t for t in self._recent_calls.get(service, []) if t > now - 1]
+                throttled = throttled or len(recent) >= self.max_calls_per_second
+                recent.append(now)
+                self._recent_calls[service] = recent
+            if throttled:
+                self.throttled[key] = self.throttled.get(key, 0) + 1
+            return throttled
+
+    def total_calls(self, service=None):
+        with self._lock:
+            return sum(count for (call_service, operation), count in self.calls.items()
+                       if service is None or call_service == service)
+
+    # environments
+
+    def event(self, message, severity='INFO', env=None, application_name=None):
+        with self._lock:
+            self.events.append({'EventDate': time(), 'Message': message, 'Severity': severity,
+                                'ApplicationName': env['ApplicationName'] if env else application_name,
+                                'EnvironmentName': env['EnvironmentName'] if env else None,
+                                'VersionLabel': env.get('VersionLabel') if env else None})
+
+    def transition(self, env, status, duration, done_status, done_message, start_message=None):
+        """
+        Puts an environment into status until duration has
+        passed, then it's done_status with done_message raised
+        """
+        with self._lock:
+            env['Status'] = status
+            env['Health'] = 'Grey'
+            env['DateUpdated'] = time()
+            env['transition'] = (time() + duration, done_status, done_message)
+            if start_message:
+                self.event(start_message, env=env)
+
+    def advance(self):
+        """
+        Finishes the transitions that are due
+        """
+        now = time()
+        with self._lock:
+            for env in self.environments.values():
+                transition = env.get('transition')
+                if transition is None or transition[0] > now:
+                    continue
+                del env['transition']
+                env['Status'] = transition[1]
+                env['DateUpdated'] = transition[0]
+                if transition[1] == 'Terminated':
+                    env['Health'] = 'Grey'
+                    env['CNAME'] = None
+                else:
+                    env['Health'] = self._health.get(env['EnvironmentName'], self.health)
+                    if env['Health'] == 'Red':
+                        self.event("Environment health has transitioned from Ok to Severe.", 'WARN', env=env)
+                self.event(transition[2], env=env)
+
+    def find_environment(self, env_name, live=True):
+        env = self.environments.get(env_name)
+        if env is None or (live and env['Status'] == 'Terminated'):
+            raise _server_error('InvalidParameterValue', 'No Environment found for EnvironmentName = ' + str(env_name))
+        return env
+
+    def environment_description(self, env):
+        description = dict((name, value) for name, value in env.items() if name != 'transition')
+        if not description.get('CNAME'):
+            description.pop('CNAME', None)
+        return description
+
+
+def _server_error(code, message, status=400):
+    from boto.exception import BotoServerError
+    body = json.dumps({'Error': {'Code': code, 'Message': message}})
+    e = BotoServerError(status, 'Bad Request', body)
+    e.error_code = code
+    e.message = message
+    return e
+
+
+class BeanstalkConnection(object):
+    """
+    The parts of boto's beanstalk Layer1 that ebs-deploy uses,
+    every call goes through _get_response like boto's do
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def _get_response(self, action, params, path='/', verb='GET'):
+        if self.simulator.call('beanstalk', action):
+            raise _server_error('Throttling', 'Rate exceeded')
+        with self.simulator._lock:
+            self.simulator.advance()
+            return _response(action, getattr(self, '_' + action)(params))
+
+    # applications
+
+    def create_application(self, application_name, description=None):
+        return self._get_response('CreateApplication', {'ApplicationName': application_name,
+                                                        'Description': description})
+
+    def _CreateApplication(self, params):
+        sim = self.simulator
+        if params['ApplicationName'] in sim.applications:
+            raise _server_error('InvalidParameterValue', 'Application ' + params['ApplicationName'] + ' already exists.')
+        application = {'ApplicationName': params['ApplicationName'], 'Description': params['Description'],
+                       'DateCreated': time()}
+        sim.applications[params['ApplicationName']] = application
+        return {'Application': application}
+
+    def delete_application(self, application_name, terminate_env_by_force=None):
+        return self._get_response('DeleteApplication', {'ApplicationName': application_name,
+                                                        'TerminateEnvByForce': terminate_env_by_force})
+
+    def _DeleteApplication(self, params):
+        sim = self.simulator
+        name = params['ApplicationName']
+        sim.applications.pop(name, None)
+        for env in list(sim.environments.values()):
+            if env['ApplicationName'] == name and env['Status'] != 'Terminated':
+                sim.transition(env, 'Terminating', sim.terminate_time, 'Terminated',
+                               'terminateEnvironment completed successfully.')
+        for key in [key for key in sim.versions if key[0] == name]:
+            del sim.versions[key]
+        return {}
+
+    def describe_applications(self, application_names=None):
+        return self._get_response('DescribeApplications', {'ApplicationNames': application_names})
+
+    def _DescribeApplications(self, params):
+        names = params['ApplicationNames']
+        return {'Applications': [dict(application) for name, application in self.simulator.applications.items()
+                                 if not names or name in names]}
+
+    def list_available_solution_stacks(self):
+        return self._get_response('ListAvailableSolutionStacks', {})
+
+    def _ListAvailableSolutionStacks(self, params):
+        return {'SolutionStacks': list(SOLUTION_STACKS),
+                'SolutionStackDetails': [{'SolutionStackName': name, 'PermittedFileTypes': ['zip']}
+                                         for name in SOLUTION_STACKS]}
+
+    # versions
+
+    def create_application_version(self, application_name, version_label, description=None, s3_bucket=None,
+                                   s3_key=None, auto_create_application=None):
+        return self._get_response('CreateApplicationVersion', {
+            'ApplicationName': application_name, 'VersionLabel': version_label, 'Description': description,
+            'SourceBundle': {'S3Bucket': s3_bucket, 'S3Key': s3_key}})
+
+    def _CreateApplicationVersion(self, params):
+        sim = self.simulator
+        key = (params['ApplicationName'], params['VersionLabel'])
+        if params['ApplicationName'] not in sim.applications:
+            raise _server_error('InvalidParameterValue', 'No Application named ' + params['ApplicationName'])
+        if key in sim.versions:
+            raise _server_error('InvalidParameterValue', 'Application Version ' + params['VersionLabel']
+                                + ' already exists.')
+        version = {'ApplicationName': params['ApplicationName'], 'VersionLabel': params['VersionLabel'],
+                   'Description': params['Description'], 'SourceBundle': params['SourceBundle'],
+                   'DateCreated': time(), 'DateUpdated': time()}
+        sim.versions[key] = version
+        return {'ApplicationVersion': dict(version)}
+
+    def delete_application_version(self, application_name, version_label, delete_source_bundle=None):
+        return self._get_response('DeleteApplicationVersion', {
+            'ApplicationName': application_name, 'VersionLabel': version_label})
+
+    def _DeleteApplicationVersion(self, params):
+        sim = self.simulator
+        for env in sim.environments.values():
+            if env['ApplicationName'] == params['ApplicationName'] and env['Status'] != 'Terminated' \
+                    and env.get('VersionLabel') == params['VersionLabel']:
+                raise _server_error('SourceBundleDeletion', 'Unable to delete application version '
+                                    + params['VersionLabel'] + ' because it is being used by an environment.')
+        sim.versions.pop((params['ApplicationName'], params['VersionLabel']), None)
+        return {}
+
+    def describe_application_versions(self, application_name=None, version_labels=None):
+        return self._get_response('DescribeApplicationVersions', {'ApplicationName': application_name,
+                                                                  'VersionLabels': version_labels})
+
+    def _DescribeApplicationVersions(self, params):
+        versions = sorted((version for version in self.simulator.versions.values()
+                           if params.get('ApplicationName') in (None, version['ApplicationName'])
+                           and (not params.get('VersionLabels') or version['VersionLabel'] in params['VersionLabels'])),
+                          key=lambda version: version['DateCreated'], reverse=True)
+        start = int(params.get('NextToken') or 0)
+        count = int(params.get('MaxRecords') or len(versions) or 1)
+        result = {'ApplicationVersions': [dict(version) for version in versions[start:start + count]]}
+        if start + count < len(versions):
+            result['NextToken'] = str(start + count)
+        return result
+
+    # environments
+
+    def create_environment(self, application_name, environment_name, version_label=None, template_name=None,
+                           solution_stack_name=None, cname_prefix=None, description=None, option_settings=None,
+                           options_to_remove=None, tier_name=None, tier_type=None, tier_version='1.0'):
+        return self._get_response('CreateEnvironment', {
+            'ApplicationName': application_name, 'EnvironmentName': environment_name,
+            'VersionLabel': version_label, 'SolutionStackName': solution_stack_name, 'CNAMEPrefix': cname_prefix,
+            'Description': description, 'OptionSettings': option_settings,
+            'Tier': {'Name': tier_name or 'WebServer', 'Type': tier_type or 'Standard',
+                     'Version': tier_version or '1.0'}})
+
+    def _CreateEnvironment(self, params):
+        sim = self.simulator
+        name = params['EnvironmentName']
+        if params['ApplicationName'] not in sim.applications:
+            raise _server_error('InvalidParameterValue', 'No Application named ' + params['ApplicationName'])
+        existing = sim.environments.get(name)
+        if existing is not None and existing['Status'] != 'Terminated':
+            raise _server_error('InvalidParameterValue', 'Environment ' + name + ' already exists.')
+        cname = None
+        if params['Tier']['Name'] == 'WebServer':
+            cname = (params['CNAMEPrefix'] or name).lower() + '.elasticbeanstalk.com'
+            for env in sim.environments.values():
+                if env.get('CNAME') == cname:
+                    raise _server_error('InvalidParameterValue', 'DNS name (' + cname + ') is not available.')
+        env = {'EnvironmentName': name, 'EnvironmentId': sim._id('e-'), 'ApplicationName': params['ApplicationName'],
+               'VersionLabel': params['VersionLabel'], 'SolutionStackName': params['SolutionStackName'],
+               'Description': params['Description'], 'CNAME': cname, 'Tier': params['Tier'],
+               'DateCreated': time(), 'DateUpdated': time(), 'Status': 'Launching', 'Health': 'Grey'}
+        sim.environments[name] = env
+        sim.transition(env, 'Launching', sim.launch_time, 'Ready', 'Successfully launched environment: ' + name,
+                       start_message='createEnvironment is starting.')
+        return sim.environment_description(env)
+
+    def describe_environments(self, application_name=None, version_label=None, environment_ids=None,
+                              environment_names=None, include_deleted=None, included_deleted_back_to=None):
+        return self._get_response('DescribeEnvironments', {
+            'ApplicationName': application_name, 'VersionLabel': version_label,
+            'EnvironmentNames': environment_names, 'IncludeDeleted': include_deleted})
+
+    def _DescribeEnvironments(self, params):
+        sim = self.simulator
+        environments = []
+        for env in sim.environments.values():
+            if params['ApplicationName'] not in (None, env['ApplicationName']):
+                continue
+            if params['EnvironmentNames'] and env['EnvironmentName'] not in params['EnvironmentNames']:
+                continue
+            if params['VersionLabel'] and env.get('VersionLabel') != params['VersionLabel']:
+                continue
+            if env['Status'] == 'Terminated' and not params['IncludeDeleted']:
+                continue
+            environments.append(sim.environment_description(env))
+        return {'Environments': environments}
+
+    def update_environment(self, environment_id=None, environment_name=None, version_label=None,
+                           template_name=None, description=None, option_settings=None, options_to_remove=None,
+                           tier_name=None, tier_type=None, tier_version='1.0'):
+        return self._get_response('UpdateEnvironment', {
+            'EnvironmentName': environment_name, 'VersionLabel': version_label, 'Description': description,
+            'OptionSettings': option_settings})
+
+    def _UpdateEnvironment(self, params):
+        sim = self.simulator
+        env = sim.find_environment(params['EnvironmentName'])
+        if env['Status'] != 'Ready':
+            raise _server_error('InvalidParameterValue', 'Environment named ' + env['EnvironmentName']
+                                + ' is in an invalid state for this operation. Must be Ready.')
+        if params['VersionLabel'] is not None:
+            if (env['ApplicationName'], params['VersionLabel']) not in sim.versions:
+                raise _server_error('InvalidParameterValue', 'No Application Version named '
+                                    + params['VersionLabel'] + ' found.')
+            env['VersionLabel'] = params['VersionLabel']
+        if params['Description'] is not None:
+            env['Description'] = params['Description']
+        sim.transition(env, 'Updating', sim.update_time, 'Ready', 'Environment update completed successfully.',
+                       start_message='Environment update is starting.')
+        return sim.environment_description(env)
+
+    def validate_configuration_settings(self, application_name, option_settings, template_name=None,
+                                        environment_name=None):
+        return self._get_response('ValidateConfigurationSettings', {
+            'ApplicationName': application_name, 'OptionSettings': option_settings,
+            'EnvironmentName': environment_name})
+
+    def _ValidateConfigurationSettings(self, params):
+        return {'Messages': []}
+
+    def rebuild_environment(self, environment_id=None, environment_name=None):
+        return self._get_response('RebuildEnvironment', {'EnvironmentName': environment_name})
+
+    def _RebuildEnvironment(self, params):
+        sim = self.simulator
+        env = sim.find_environment(params['EnvironmentName'])
+        sim.transition(env, 'Launching', sim.launch_time, 'Ready', 'Environment rebuild completed successfully.',
+                       start_message='rebuildEnvironment is starting.')
+        return {}
+
+    def swap_environment_cnames(self, source_environment_id=None, source_environment_name=None,
+                                destination_environment_id=None, destination_environment_name=None):
+        return self._get_response('SwapEnvironmentCNAMEs', {
+            'SourceEnvironmentName': source_environment_name,
+            'DestinationEnvironmentName': destination_environment_name})
+
+    def _SwapEnvironmentCNAMEs(self, params):
+        sim = self.simulator
+        source = sim.find_environment(params['SourceEnvironmentName'])
+        destination = sim.find_environment(params['DestinationEnvironmentName'])
+        for env in (source, destination):
+            if env['Status'] != 'Ready':
+                raise _server_error('InvalidParameterValue', 'Environment named ' + env['EnvironmentName']
+                                    + ' is in an invalid state for this operation. Must be Ready.')
+        source['CNAME'], destination['CNAME'] = destination['CNAME'], source['CNAME']
+        for env in (source, destination):
+            sim.transition(env, 'Updating', sim.swap_time, 'Ready', 'Completed swapping CNAMEs for environments.')
+        return {}
+
+    def terminate_environment(self, environment_id=None, environment_name=None, terminate_resources=None):
+        return self._get_response('TerminateEnvironment', {'EnvironmentName': environment_name})
+
+    def _TerminateEnvironment(self, params):
+        sim = self.simulator
+        env = sim.find_environment(params['EnvironmentName'])
+        sim.transition(env, 'Terminating', sim.terminate_time, 'Terminated',
+                       'Terminated environment ' + env['EnvironmentName'] + '.',
+                       start_message='terminateEnvironment is starting.')
+        return sim.environment_description(env)
+
+    # events
+
+    def describe_events(self, application_name=None, version_label=None, template_name=None, environment_id=None,
+                        environment_name=None, request_id=None, severity=None, start_time=None, end_time=None,
+                        max_records=None, next_token=None):
+        return self._get_response('DescribeEvents', {
+            'ApplicationName': application_name, 'EnvironmentName': environment_name, 'StartTime': start_time,
+            'MaxRecords': max_records, 'NextToken': next_token})
+
+    def _DescribeEvents(self, params):
+        start_time = parse_timestamp(params['StartTime']) if params['StartTime'] else None
+        events = [event for event in reversed(self.simulator.events)
+                  if params['ApplicationName'] in (None, event['ApplicationName'])
+                  and params['EnvironmentName'] in (None, event['EnvironmentName'])
+                  and (start_time is None or event['EventDate'] >= start_time)]
+        start = int(params['NextToken'] or 0)
+        count = int(params['MaxRecords'] or EVENT_PAGE_SIZE)
+        return {'Events': [dict(event) for event in events[start:start + count]],
+                'NextToken': str(start + count) if start + count < len(events) else None}
+
+
+class _Response(object):
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'OK' if status < 400 else 'Error'
+
+
+class S3Connection(object):
+    """
+    The parts of boto's S3Connection, Bucket, Key and
+    MultiPartUpload that ebs-deploy uses.  Every request goes
+    through make_request like boto's do.
+    """
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def make_request(self, method, bucket='', key='', headers=None, data='', query_args=None, sender=None,
+                     override_num_retries=None, retry_handler=None):
+        from ebs_deploy import _s3_operation
+        operation = _s3_operation(method, bucket, key, query_args)
+        return _Response(503 if self.simulator.call('s3', operation) else 200)
+
+    def request(self, method, bucket, key='', query_args=None):
+        """
+        Makes a request, raising boto's S3ResponseError when
+        it's throttled or the bucket doesn't exist
+        """
+        from boto.exception import S3ResponseError
+        response = self.make_request(method, bucket, key, query_args=query_args)
+        if response.status == 503:
+            raise S3ResponseError(503, 'Slow Down', '<Error><Code>SlowDown</Code></Error>')
+        if (bucket and method != 'PUT') or key:
+            if bucket not in self.simulator.buckets:
+                raise S3ResponseError(404, 'Not Found', '<Error><Code>NoSuchBucket</Code></Error>')
+        return response
+
+    def get_bucket(self, bucket_name, validate=True, headers=None):
+        if validate:
+            self.request('HEAD', bucket_name)
+        return Bucket(self, bucket_name)
+
+    def create_bucket(self, bucket_name, headers=None, location='', policy=None):
+        self.request('PUT', bucket_name)
+        self.simulator.add_bucket(bucket_name, '' if location in (None, '', 'us-east-1') else location)
+        return Bucket(self, bucket_name)
+
+
+class Bucket(object):
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    @property
+    def _state(self):
+        return self.connection.simulator.buckets[self.name]
+
+    def get_location(self):
+        self.connection.request('GET', self.name, query_args='location')
+        return self._state['location']
+
+    def new_key(self, key_name=None):
+        return Key(self, key_name)
+
+    def get_key(self, key_name, headers=None, version_id=None):
+        self.connection.request('HEAD', self.name, key_name)
+        stored = self._state['keys'].get(key_name)
+        return Key(self, key_name, stored) if stored is not None else None
+
+    def list(self, prefix='', delimiter='', marker='', headers=None):
+        names = sorted(name for name in self._state['keys'] if name.startswith(prefix or ''))
+        for i in range(0, max(1, len(names)), LIST_PAGE_SIZE):
+            self.connection.request('GET', self.name)
+            for name in names[i:i + LIST_PAGE_SIZE]:
+                stored = self._state['keys'].get(name)
+                if stored is not None:
+                    yield Key(self, name, stored)
+
+    def delete_keys(self, keys, quiet=False, mfa_token=None, headers=None):
+        result = _DeleteResult()
+        for i in range(0, len(keys), LIST_PAGE_SIZE):
+            self.connection.request('POST', self.name, query_args='delete')
+            with self.connection.simulator._lock:
+                for key in keys[i:i + LIST_PAGE_SIZE]:
+                    name = getattr(key, 'name', key)
+                    self._state['keys'].pop(name, None)
+                    result.deleted.append(name)
+        return result
+
+    def get_all_multipart_uploads(self, key_marker='', upload_id_marker='', headers=None, prefix=None, **kwargs):
+        self.connection.request('GET', self.name, query_args='uploads')
+        return [upload for upload in list(self._state['uploads'].values())
+                if upload.key_name.startswith(prefix or '')]
+
+    def initiate_multipart_upload(self, key_name, headers=None, reduced_redundancy=False, metadata=None,
+                                  encrypt_key=False, policy=None):
+        self.connection.request('POST', self.name, key_name, query_args='uploads')
+        upload = MultiPartUpload(self, key_name, self.connection.simulator._id('upload-'), metadata)
+        with self.connection.simulator._lock:
+            self._state['uploads'][upload.id] = upload
+        return upload
+
+
+class _DeleteResult(object):
+
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+
+
+class Key(object):
+
+    def __init__(self, bucket, name=None, stored=None):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = dict(stored['metadata']) if stored else {}
+        self.size = stored['size'] if stored else None
+        self.etag = stored['etag'] if stored else None
+
+    @property
+    def key(self):
+        return self.name
+
+    @key.setter
+    def key(self, value):
+        self.name = value
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_filename(self, filename, headers=None, replace=True, cb=None, num_cb=10, **kwargs):
+        with open(filename, 'rb') as fp:
+            return self.set_contents_from_file(fp, cb=cb, num_cb=num_cb)
+
+    def set_contents_from_file(self, fp, headers=None, replace=True, cb=None, num_cb=10, size=None, **kwargs):
+        md5 = hashlib.md5()
+        sent = 0
+        while size is None or sent < size:
+            chunk = fp.read(1024 * 1024 if size is None else min(1024 * 1024, size - sent))
+            if not chunk:
+                break
+            md5.update(chunk)
+            sent += len(chunk)
+        self.bucket.connection.request('PUT', self.bucket.name, self.name)
+        self.size = sent
+        self.etag = '"' + md5.hexdigest() + '"'
+        with self.bucket.connection.simulator._lock:
+            self.bucket._state['keys'][self.name] = {'size': self.size, 'etag': self.etag,
+                                                     'metadata': dict(self.metadata)}
+        if cb:
+            cb(sent, sent)
+        return sent
+
+
+class _Part(object):
+
+    def __init__(self, part_number, size, etag):
+        self.part_number = part_number
+        self.size = size
+        self.etag = etag
+
+
+class MultiPartUpload(object):
+
+    def __init__(self, bucket, key_name, upload_id, metadata=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = upload_id
+        self.metadata = dict(metadata or {})
+        self.parts = {}
+
+    def __iter__(self):
+        self.bucket.connection.request('GET', self.bucket.name, self.key_name, query_args='uploadId=' + self.id)
+        return iter([self.parts[number] for number in sorted(self.parts)])
+
+    def upload_part_from_file(self, fp, part_num, headers=None, replace=True, cb=None, num_cb=10, md5=None,
+                              size=None):
+        data = fp.read(size) if size is not None else fp.read()
+        self.bucket.connection.request('PUT', self.bucket.name, self.key_name,
+                                       query_args='uploadId=' + self.id + '&partNumber=' + str(part_num))
+        with self.bucket.connection.simulator._lock:
+            self.parts[part_num] = _Part(part_num, len(data), '"' + hashlib.md5(data).hexdigest() + '"')
+
+    def complete_upload(self):
+        self.bucket.connection.request('POST', self.bucket.name, self.key_name, query_args='uploadId=' + self.id)
+        with self.bucket.connection.simulator._lock:
+            parts = [self.parts[number] for number in sorted(self.parts)]
+            digest = hashlib.md5(b''.join(bytes(bytearray.fromhex(part.etag.strip('"'))) for part in parts))
+            self.bucket._state['keys'][self.key_name] = {
+                'size': sum(part.size for part in parts),
+                'etag': '"' + digest.hexdigest() + '-' + str(len(parts)) + '"',
+                'metadata': dict(self.metadata)}
+            self.bucket._state['uploads'].pop(self.id, None)
+
+    def cancel_upload(self):
+        self.bucket.connection.request('DELETE', self.bucket.name, self.key_name, query_args='uploadId=' + self.id)
+        with self.bucket.connection.simulator._lock:
+            self.bucket._state['uploads'].pop(self.id, None)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Measures how long ebs-deploy takes to start up and run
+commands that don't talk to aws (help and dump), run
+locally and through a daemon (ebs-deploy serve).
+
+    > python benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'scripts', 'ebs-deploy')
+
+CONFIG = """
+aws:
+    access_key: 'benchmark'
+    secret_key: 'benchmark'
+    region: 'us-west-2'
+    bucket: 'benchmark-bucket'
+    bucket_path: 'benchmark'
+
+app:
+    app_name: 'Benchmark'
+    all_environments:
+        solution_stack_name: '64bit Amazon Linux running Python'
+        option_settings:
+            'aws:autoscaling:asg':
+                MinSize: 1
+                MaxSize: 5
+    environments:
+        'Benchmark-Prod':
+            cname_prefix: 'benchmark-prod'
+"""
+
+
+def command_env(socket_path=None):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env.pop('EBS_DEPLOY_NO_DAEMON', None)
+    if socket_path:
+        env['EBS_DEPLOY_SOCKET'] = socket_path
+    else:
+        env['EBS_DEPLOY_NO_DAEMON'] = '1'
+    return env
+
+
+def time_command(args, cwd, runs, env):
+    """
+    Runs a command runs times and returns the timings in ms
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            started = time()
+            code = subprocess.call(args, cwd=cwd, env=env, stdout=devnull, stderr=devnull)
+            timings.append((time() - started) * 1000)
+            if code not in (0, 255):
+                raise Exception("Command failed with exit code " + str(code) + ": " + " ".join(args))
+    return sorted(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ebs-deploy startup benchmark')
+    parser.add_argument('-r', '--runs', help='Number of runs per command', type=int, default=10)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'ebs.config'), 'w') as f:
+            f.write(CONFIG)
+
+        commands = [
+            ('python', [sys.executable, '-c', 'pass']),
+            ('help', [sys.executable, SCRIPT, 'help']),
+            ('dump', [sys.executable, SCRIPT, 'dump', '-e', 'Benchmark-Prod'])
+        ]
+        socket_path = os.path.join(directory, 'daemon.sock')
+        daemon = subprocess.Popen([sys.executable, SCRIPT, 'serve', '--socket', socket_path],
+                                  cwd=directory, env=command_env(), stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(socket_path):
+                sleep(0.05)
+
+            print("%-16s %10s %10s %10s" % ('command', 'min ms', 'median ms', 'max ms'))
+            for mode, env in (('', command_env()), (' (daemon)', command_env(socket_path))):
+                for name, command in commands:
+                    timings = time_command(command, directory, args.runs, env)
+                    print("%-16s %10.1f %10.1f %10.1f" % (name + mode, timings[0], timings[len(timings) // 2],
+                                                         timings[-1]))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
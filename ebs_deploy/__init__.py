@@ -1,28 +1,336 @@
-from boto.exception import S3ResponseError
-from boto.s3.connection import S3Connection
-from boto.beanstalk import connect_to_region
-from boto.s3.key import Key
+# boto, yaml and the heavier parts of the standard library
+# (zipfile, concurrent.futures, subprocess) are imported where
+# they're used so that commands which don't need them start
+# quickly
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from time import time, sleep
-import zipfile
+from collections import deque, namedtuple
+import zlib
+import hashlib
+import json
+import struct
+import math
+import random
+import threading
 import os
-import subprocess
 import sys
-import yaml
 import re
-import functools
+import heapq
+import copy
 
 
 MAX_RED_SAMPLES = 20
+ARCHIVE_CHUNK_SIZE = 1024 * 8
+ARCHIVE_MANIFEST = '.ebs-deploy-manifest.json'
+ARCHIVE_STREAM_FILE_SIZE = 4 * 1024 * 1024
+STANDBY_DESCRIPTION = 'ebs-deploy standby for '
+GENERATE_EXCLUDE_DIRS = ['.git', '.svn', '.hg', 'node_modules', '__pycache__', '.tox', '.venv']
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_RETRIES = 5
+DEFAULT_CACHE_FILE = os.path.join('~', '.ebs-deploy', 'cache.json')
+DEFAULT_CACHE_TTL = 3600
+MAX_SEEN_EVENTS = 1000
+GC_RATE = 5.0
+GC_WORKERS = 4
+GC_MAX_ATTEMPTS = 10
+S3_DELETE_BATCH_SIZE = 1000
+VERSION_PAGE_SIZE = 500
+TRANSITIONAL_STATUSES = ('Launching', 'Updating', 'Terminating')
+NEAR_DONE_EVENTS = [
+    r'.*[Ss]uccessfully launched',
+    r'.*update completed successfully',
+    r'.*[Ii]nstance deployment completed',
+    r'.*[Cc]ompleted swapping CNAMEs',
+    r'.*[Hh]ealth has transitioned',
+    r'.*[Tt]erminated environment',
+    r'.*[Ss]uccessfully deployed new configuration'
+]
+
+
+_output = threading.local()
+_output_lock = threading.Lock()
+_trace = None
 
 
 def out(message):
     """
-    print alias
+    print alias, messages are prefixed with the current
+    thread's output prefix (see for_each_environment)
     """
-    sys.stdout.write(message + "\n")
-    sys.stdout.flush()
+    prefix = getattr(_output, 'prefix', None)
+    if prefix:
+        message = prefix + message
+    with _output_lock:
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+
+
+def for_each_environment(environment_names, func, parallel=1):
+    """
+    Calls func(env_name) for every environment, up to parallel
+    of them at a time.  While func runs output is prefixed with
+    the environment name.  Errors are collected and reported once
+    every environment has been handled, returns a dict of
+    env_name to result and raises if any environment failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    results = {}
+    errors = []
+    parent = current_span()
+
+    def _run(env_name):
+        if parallel > 1:
+            _output.prefix = "[" + str(env_name) + "] "
+        try:
+            with span('environment', parent=parent, environment=env_name):
+                results[env_name] = func(env_name)
+        except Exception as e:
+            errors.append((env_name, e))
+            out("Failed: " + str(e))
+        finally:
+            _output.prefix = None
+
+    if parallel > 1:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            list(executor.map(_run, environment_names))
+    else:
+        for env_name in environment_names:
+            _run(env_name)
+
+    if errors:
+        out(str(len(errors)) + " of " + str(len(environment_names)) + " environment(s) failed:")
+        for env_name, e in errors:
+            out("    " + str(env_name) + ": " + str(e))
+        raise Exception("Failed environment(s): " + ", ".join(str(env_name) for env_name, e in errors))
+    return results
+
+
+class Stage(namedtuple('Stage', ['name', 'func', 'requires'])):
+    """
+    A step of run_stages(), func(results) runs once every
+    stage named in requires has finished
+    """
+
+    def __new__(cls, name, func, requires=()):
+        return super(Stage, cls).__new__(cls, name, func, tuple(requires))
+
+
+def run_stages(stages):
+    """
+    Runs a dependency graph of Stages, starting each one as
+    soon as the stages it requires are done so independent
+    stages overlap.  Every func gets the dict of stage name to
+    result so far, which is also returned.  When a stage fails
+    no new stages are started and the error is raised once the
+    running ones finish.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    names = set(stage.name for stage in stages)
+    for stage in stages:
+        missing = [name for name in stage.requires if name not in names]
+        if missing:
+            raise Exception("Stage " + stage.name + " requires unknown stage(s): " + ", ".join(missing))
+
+    results = {}
+    pending = list(stages)
+    running = {}
+    parent = current_span()
+
+    def _run(stage):
+        with span(stage.name, parent=parent):
+            return stage.func(results)
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while pending or running:
+            if error is None:
+                for stage in [s for s in pending if all(name in results for name in s.requires)]:
+                    pending.remove(stage)
+                    running[executor.submit(_run, stage)] = stage
+            if not running:
+                if error is None:
+                    raise Exception("Stages can never run, circular requirements: "
+                                    + ", ".join(stage.name for stage in pending))
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    error = error or e
+    if error is not None:
+        raise error
+    return results
+
+
+class Trace(object):
+    """
+    Records nested timing spans.  Spans nest per thread, spans
+    started on worker threads can name their parent explicitly
+    (see for_each_environment).  Saved as a json tree or in the
+    chrome trace format (chrome://tracing, ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def current(self):
+        """
+        Returns the innermost open span on this thread
+        """
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def begin(self, name, parent=None, args=None):
+        with self._lock:
+            self._next_id += 1
+            span_id = self._next_id
+        if parent is None:
+            parent = self.current()
+        thread = threading.current_thread()
+        span = {'id': span_id, 'parent': parent['id'] if parent else None, 'name': name,
+                'thread': thread.name, 'tid': thread.ident, 'start': time(), 'args': args or {}}
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        self._local.stack.append(span)
+        return span
+
+    def end(self, span, error=None):
+        span['duration'] = time() - span['start']
+        if error is not None:
+            span['error'] = str(error)
+        self._local.stack.remove(span)
+        with self._lock:
+            self.spans.append(span)
+
+    def to_json(self):
+        """
+        Returns the spans as a tree, times in seconds from the
+        start of the trace
+        """
+        nodes = {}
+        for span in sorted(self.spans, key=lambda span: span['start']):
+            node = {'name': span['name'], 'thread': span['thread'],
+                    'start': round(span['start'] - self.started, 6),
+                    'duration': round(span['duration'], 6), 'children': []}
+            if span['args']:
+                node['args'] = span['args']
+            if 'error' in span:
+                node['error'] = span['error']
+            nodes[span['id']] = (span, node)
+        roots = []
+        for span, node in nodes.values():
+            parent = nodes.get(span['parent'])
+            if parent:
+                parent[1]['children'].append(node)
+            else:
+                roots.append(node)
+        roots.sort(key=lambda node: node['start'])
+        for span, node in nodes.values():
+            node['children'].sort(key=lambda child: child['start'])
+        return {'started': datetime.utcfromtimestamp(self.started).isoformat() + 'Z', 'spans': roots}
+
+    def to_chrome(self):
+        """
+        Returns the spans as chrome trace complete events
+        """
+        events = []
+        for span in self.spans:
+            args = dict(span['args'])
+            if 'error' in span:
+                args['error'] = span['error']
+            events.append({'name': span['name'], 'cat': 'ebs-deploy', 'ph': 'X',
+                           'ts': int((span['start'] - self.started) * 1000000),
+                           'dur': int(span['duration'] * 1000000),
+                           'pid': os.getpid(), 'tid': span['tid'], 'args': args})
+        events.sort(key=lambda event: event['ts'])
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, filename, format='chrome'):
+        with open(filename, 'w') as f:
+            json.dump(self.to_chrome() if format == 'chrome' else self.to_json(), f, indent=1, default=str)
+
+
+class _Span(object):
+    """
+    Context manager returned by span()
+    """
+
+    def __init__(self, name, parent, args):
+        self.name = name
+        self.parent = parent
+        self.args = args
+        self.trace = _trace
+        self.span = None
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.span = self.trace.begin(self.name, parent=self.parent, args=self.args)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.span is not None:
+            failed = exc_type is not None and issubclass(exc_type, Exception)
+            self.trace.end(self.span, error=exc_value if failed else None)
+        return False
+
+
+def start_trace():
+    """
+    Starts recording spans, returns the Trace
+    """
+    global _trace
+    _trace = Trace()
+    return _trace
+
+
+def stop_trace():
+    """
+    Stops recording spans, returns the Trace (or None)
+    """
+    global _trace
+    trace, _trace = _trace, None
+    return trace
+
+
+def span(name, parent=None, **args):
+    """
+    Times the enclosed block when tracing, does nothing
+    otherwise:
+
+        with span('upload', key=key):
+            ...
+    """
+    return _Span(name, parent, args)
+
+
+def current_span():
+    """
+    Returns the innermost open span on this thread, to be
+    passed as the parent of spans on other threads
+    """
+    return _trace.current() if _trace is not None else None
+
+
+def traced(name, *arg_names):
+    """
+    Decorator that runs a method in a span, the first
+    positional arguments after self are recorded as arg_names
+    """
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            with span(name, **dict(zip(arg_names, (str(arg) for arg in args)))):
+                return func(self, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
 
 
 def merge_dict(dict1, dict2):
@@ -55,27 +363,100 @@ def get(vals, key, default_val=None):
     return val
 
 
+_env_configs = {}
+_option_settings = {}
+_config_file_contents = {}
+
+
+def clear_config_caches():
+    """
+    Forgets what parse_env_config, parse_option_settings and
+    archive.files rendering remembered, the command line
+    does this before every command
+    """
+    _env_configs.clear()
+    _option_settings.clear()
+    _config_file_contents.clear()
+
+
+def yaml_loader():
+    """
+    Returns the fastest yaml loader available, the libyaml
+    based one when PyYAML was built with it
+    """
+    import yaml
+    for name in ('CFullLoader', 'FullLoader', 'CLoader', 'Loader'):
+        loader = getattr(yaml, name, None)
+        if loader is not None:
+            return loader
+
+
+def load_config(filename):
+    """
+    Loads a configuration file, expanding environment variables.
+    The parsed config isn't cached since the expanded variables
+    are often credentials.
+    """
+    with open(filename, 'r') as f:
+        contents = os.path.expandvars(f.read())
+
+    import yaml
+    return yaml.load(contents, Loader=yaml_loader())
+
+
 def parse_option_settings(option_settings):
     """
-    Parses option_settings as they are defined in the configuration file
+    Parses option_settings as they are defined in the configuration file,
+    the result is computed once per option_settings dict
     """
+    if not option_settings:
+        return []
+    cached = _option_settings.get(id(option_settings))
+    if cached is not None and cached[0] is option_settings:
+        return list(cached[1])
     ret = []
     for namespace, params in list(option_settings.items()):
         for key, value in list(params.items()):
             ret.append((namespace, key, value))
-    return ret
+    _option_settings[id(option_settings)] = (option_settings, ret)
+    return list(ret)
+
+
+def _megabytes(value):
+    """
+    Converts a size in megabytes from the config to bytes
+    """
+    if value is None:
+        return None
+    return int(float(value) * 1024 * 1024)
 
 
 def parse_env_config(config, env_name):
     """
-    Parses an environment config
+    Parses an environment config, the merged config is
+    computed once per config and environment
     """
+    key = (id(config), str(env_name))
+    cached = _env_configs.get(key)
+    if cached is not None and cached[0] is config:
+        return cached[1]
     all_env = get(config, 'app.all_environments', {})
     env = get(config, 'app.environments.' + str(env_name), {})
-    return merge_dict(all_env, env)
+    merged = merge_dict(all_env, env)
+    if config:
+        _env_configs[key] = (config, merged)
+    return merged
 
 
-def upload_application_archive(helper, env_config, archive=None, directory=None, version_label=None):
+def upload_application_archive(helper, env_config, archive=None, directory=None, version_label=None,
+                               archive_workers=None, before_create=None):
+    """
+    Builds (or generates) the archive, uploads it and creates
+    the application version, returns its label.  before_create
+    is called once the archive is uploaded, if it raises no
+    application version is created.
+    """
+    import subprocess
     if version_label is None:
         version_label = datetime.now().strftime('%Y%m%d_%H%M%S')
     archive_file_name = None
@@ -90,134 +471,1538 @@ def upload_application_archive(helper, env_config, archive=None, directory=None,
         output_file = get(env_config, 'archive.generate.output_file')
         use_shell = get(env_config, 'archive.generate.use_shell', True)
         exit_code = get(env_config, 'archive.generate.exit_code', 0)
-        if not cmd or not output_file:
-            raise Exception('Archive generation requires cmd and output_file at a minimum')
-        output_regex = None
-        try:
-            output_regex = re.compile(output_file)
-        except:
-            pass
-        result = subprocess.call(cmd, shell=use_shell)
+        if not cmd or not (output_file or get(env_config, 'archive.generate.reported_output')):
+            raise Exception('Archive generation requires cmd and output_file (or reported_output) at a minimum')
+        reported_output = get(env_config, 'archive.generate.reported_output')
+        started = time()
+        with span('archive.generate', cmd=str(cmd)):
+            if reported_output:
+                result, reported = _run_generate(cmd, use_shell, reported_output)
+            else:
+                result, reported = subprocess.call(cmd, shell=use_shell), None
         if result != exit_code:
             raise Exception('Generate command exited with code %s (expected %s)' % (result, exit_code))
 
-        if output_file and os.path.exists(output_file):
-            archive_file_name = os.path.basename(output_file)
+        if reported and os.path.isfile(reported):
+            out("Generate command reported output file " + str(reported))
+            archive = reported
+        elif output_file and os.path.exists(output_file):
             directory = os.path.dirname(output_file)
             archive = output_file
         else:
-            for root, dirs, files in os.walk(".", followlinks=True):
-                for f in files:
-                    fullpath = os.path.join(root, f)
-                    if fullpath.endswith(output_file):
-                        archive = fullpath
-                        archive_file_name = os.path.basename(fullpath)
-                        break
-                    elif output_regex and output_regex.match(fullpath):
-                        archive = fullpath
-                        archive_file_name = os.path.basename(fullpath)
-                        break
-                if archive:
-                    break
-            if not archive or not archive_file_name:
+            with span('archive.find'):
+                archive = find_generated_archive(output_file, search=get(env_config, 'archive.generate.search'),
+                                                 exclude_dirs=get(env_config, 'archive.generate.exclude_dirs'),
+                                                 since=started)
+            if not archive:
                 raise Exception('Unable to find expected output file matching: %s' % (output_file))
+        archive_file_name = os.path.basename(archive)
 
     # create the archive
     elif not archive:
         if not directory:
             directory = "."
-        includes = get(env_config, 'archive.includes', [])
-        excludes = get(env_config, 'archive.excludes', [])
-
-        def _predicate(f):
-            for exclude in excludes:
-                if re.match(exclude, f):
-                    return False
-            if len(includes) > 0:
-                for include in includes:
-                    if re.match(include, f):
-                        return True
-                return False
-            return True
-        archive = create_archive(directory, str(version_label) + ".zip", config=archive_files, ignore_predicate=_predicate)
+        matcher = ArchiveMatcher(get(env_config, 'archive.includes', []),
+                                 get(env_config, 'archive.excludes', []))
+        if archive_workers is None:
+            archive_workers = int(get(env_config, 'archive.workers', 1))
         archive_file_name = str(version_label) + ".zip"
 
-    add_config_files_to_archive(directory, archive, config=archive_files)
-    helper.upload_archive(archive, archive_file_name)
-    helper.create_application_version(version_label, archive_file_name)
+        # build it straight into s3 without a local file
+        if get(env_config, 'archive.stream', False):
+            stream_application_archive(helper, env_config, directory, archive_file_name, version_label,
+                                       ignore_predicate=matcher, archive_workers=archive_workers,
+                                       before_create=before_create)
+            return version_label
+
+        with span('archive.build', workers=archive_workers):
+            archive = create_archive(directory, archive_file_name, config=archive_files,
+                                     ignore_predicate=matcher, workers=archive_workers,
+                                     incremental=get(env_config, 'archive.incremental', False))
+        return _upload_archive_file(helper, env_config, archive, archive_file_name, version_label,
+                                    before_create=before_create)
+
+    # add the config files to a copy of a prebuilt archive, the
+    # original is left alone
+    if archive_files:
+        import tempfile
+        (fd, derived) = tempfile.mkstemp(suffix='.zip', prefix=str(version_label) + '-')
+        os.close(fd)
+        try:
+            with span('archive.derive'):
+                derive_archive(archive, derived, config=archive_files)
+            return _upload_archive_file(helper, env_config, derived, archive_file_name, version_label,
+                                        before_create=before_create)
+        finally:
+            os.remove(derived)
+    return _upload_archive_file(helper, env_config, archive, archive_file_name, version_label,
+                                before_create=before_create)
+
+
+def _upload_archive_file(helper, env_config, archive, archive_file_name, version_label, before_create=None):
+    """
+    Uploads an archive (unless it's a duplicate) and creates
+    the application version, returns the version label
+    """
+    multipart_threshold = _megabytes(get(env_config, 'archive.upload.multipart_threshold_mb', 100))
+    part_size = _megabytes(get(env_config, 'archive.upload.part_size_mb', 16))
+
+    # reuse an identical archive that has already been uploaded,
+    # deduplicated archives are stored under their content key
+    content_hash = etag = None
+    if get(env_config, 'archive.deduplicate', False):
+        with span('archive.digest'):
+            content_hash, etag = archive_digest(archive, multipart_threshold=multipart_threshold, part_size=part_size)
+        existing_key = helper.find_archive_by_hash(content_hash, etag)
+        if existing_key is not None:
+            out("Archive is identical to " + str(existing_key) + ", skipping upload")
+            if before_create is not None:
+                before_create()
+            helper.create_application_version(version_label, existing_key, content_hash=content_hash)
+            return version_label
+        archive_file_name = content_key(content_hash)
+
+    key = helper.upload_archive(archive, archive_file_name,
+                                multipart_threshold=multipart_threshold,
+                                part_size=part_size,
+                                workers=int(get(env_config, 'archive.upload.workers', 4)),
+                                content_hash=content_hash, etag=etag)
+    if before_create is not None:
+        before_create()
+    helper.create_application_version(version_label, key, content_hash=content_hash)
     return version_label
 
 
-def create_archive(directory, filename, config={}, ignore_predicate=None, ignored_files=['.git', '.svn']):
+def _run_generate(cmd, use_shell, reported_output):
+    """
+    Runs the generate command, echoing its output, and
+    returns (exit_code, path) where path is the first group
+    (or the whole match) of the first line reported_output
+    matches, or None
+    """
+    import subprocess
+    pattern = re.compile(reported_output)
+    reported = None
+    process = subprocess.Popen(cmd, shell=use_shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    for line in process.stdout:
+        line = line.rstrip('\n')
+        out(line)
+        if reported is None:
+            match = pattern.search(line)
+            if match:
+                reported = (match.group(1) if match.groups() else match.group(0)).strip()
+    return process.wait(), reported
+
+
+def _literal_directory(pattern):
+    """
+    Returns the leading directories of an output_file
+    pattern that contain no regex or glob syntax
+    """
+    literal = []
+    for part in pattern.split('/')[:-1]:
+        if part not in ('.', '..') and re.search(r'[\\.*+?\[\](){}|^$]', part):
+            break
+        literal.append(part)
+    return '/'.join(literal)
+
+
+def find_generated_archive(output_file, search=None, exclude_dirs=None, since=None):
+    """
+    Returns the newest file matching output_file (a path
+    suffix or a regex matched against ./relative/paths), or
+    None.  search is a list of directories or glob patterns
+    to look in, by default the literal leading directories
+    of output_file or the working directory.  Directories in
+    exclude_dirs (and GENERATE_EXCLUDE_DIRS) aren't walked.
+    Matches older than since are reported as likely stale.
+    """
+    import glob
+    output_regex = None
+    if output_file:
+        try:
+            output_regex = re.compile(output_file)
+        except re.error:
+            pass
+
+    def _matches(path):
+        if not output_file:
+            return True
+        path = path if path.startswith('.') or os.path.isabs(path) else os.path.join('.', path)
+        return path.endswith(output_file) or bool(output_regex and output_regex.match(path))
+
+    excluded = set(GENERATE_EXCLUDE_DIRS) | set(exclude_dirs or [])
+    if not search:
+        literal = _literal_directory(output_file or '')
+        search = [literal if literal and os.path.isdir(literal) else '.']
+    elif not isinstance(search, (list, tuple)):
+        search = [search]
+
+    candidates = []
+    for entry in search:
+        if glob.has_magic(entry):
+            candidates.extend(path for path in glob.glob(entry, recursive=True)
+                              if os.path.isfile(path) and _matches(path))
+            continue
+        root_dir = entry if entry.startswith('.') or os.path.isabs(entry) else os.path.join('.', entry)
+        for root, dirs, files in os.walk(root_dir, followlinks=True):
+            dirs[:] = [d for d in dirs if d not in excluded]
+            candidates.extend(os.path.join(root, f) for f in files if _matches(os.path.join(root, f)))
+
+    if not candidates:
+        return None
+    newest = max(candidates, key=os.path.getmtime)
+    if len(candidates) > 1:
+        out("Found " + str(len(candidates)) + " files matching " + str(output_file) + ", using the newest: "
+            + str(newest))
+    if since is not None and os.path.getmtime(newest) < since:
+        out("Warning: " + str(newest) + " is older than the generate command, it may be a stale build")
+    return newest
+
+
+def stream_application_archive(helper, env_config, directory, archive_file_name, version_label,
+                               ignore_predicate=None, archive_workers=1, before_create=None):
+    """
+    Builds the archive (with archive.files) straight into a
+    multipart upload and creates the application version
+    (after calling before_create, if given).  Only
+    archive.upload.workers + 1 parts are held in memory and
+    nothing is written to disk.
+    """
+    if get(env_config, 'archive.deduplicate', False):
+        out("Streamed archives can't be deduplicated before they're uploaded, uploading it")
+    with span('archive.stream', workers=archive_workers):
+        upload = helper.open_archive_stream(archive_file_name,
+                                            part_size=_megabytes(get(env_config, 'archive.upload.part_size_mb', 16)),
+                                            workers=int(get(env_config, 'archive.upload.workers', 4)))
+        try:
+            write_archive(directory, upload, archive_file_name, config=get(env_config, 'archive.files', []),
+                          ignore_predicate=ignore_predicate, workers=archive_workers)
+            upload.close()
+        except BaseException:
+            upload.abort()
+            raise
+    if before_create is not None:
+        before_create()
+    helper.create_application_version(version_label, archive_file_name, content_hash=upload.sha256)
+
+
+def collect_unused_versions(helper, config, deploying=False):
+    """
+    Deletes unused application versions as configured by
+    app.versions_to_keep and app.gc, when deploying nothing
+    is done if app.gc.on_deploy is false
+    """
+    if deploying and not get(config, 'app.gc.on_deploy', True):
+        return []
+    return helper.delete_unused_versions(versions_to_keep=int(get(config, 'app.versions_to_keep', 10)),
+                                         delete_source_bundles=get(config, 'app.gc.delete_source_bundles', False),
+                                         workers=int(get(config, 'app.gc.workers', GC_WORKERS)),
+                                         rate=float(get(config, 'app.gc.rate', GC_RATE)))
+
+
+def rollback_versions(helper, config, versions):
+    """
+    Redeploys the version each environment had before (a dict
+    of env_name to version_label) when fail_fast.rollback is
+    set, returns whether it did.  The environments are waited
+    for until they can be updated, the rollbacks aren't.
+    """
+    if not get(config, 'fail_fast.rollback', False):
+        return False
+    helper.wait_for_environments(list(versions.keys()), status='Ready', include_deleted=False, fail_fast=False)
+    for env_name, version_label in sorted(versions.items()):
+        if version_label is None:
+            out("No previous version to roll " + env_name + " back to")
+            continue
+        out("Rolling " + env_name + " back to " + version_label)
+        try:
+            helper.deploy_version(env_name, version_label)
+        except Exception as e:
+            out("Unable to roll " + env_name + " back: " + str(e))
+    return True
+
+
+def free_environment_name(helper, env_name, taken=()):
+    """
+    Returns the first of env_name-0 ... env_name-9 that isn't
+    an environment (or in taken), or None
+    """
+    for i in range(10):
+        temp_env_name = env_name + '-' + str(i)
+        if temp_env_name not in taken and not helper.environment_exists(temp_env_name):
+            return temp_env_name
+    return None
+
+
+def free_cname_prefix(helper, cname_prefix, taken=()):
+    """
+    Returns the first of cname_prefix-0 ... cname_prefix-9
+    that no environment uses (or in taken), or None
+    """
+    for i in range(10):
+        temp_cname = cname_prefix + '-' + str(i)
+        if temp_cname not in taken and not helper.environment_name_for_cname(temp_cname):
+            return temp_cname
+    return None
+
+
+def fill_standby_pool(helper, env_config, env_name, size=None):
+    """
+    Creates standby environments for env_name until there are
+    standby.size of them (or size), running the version that's
+    live on env_name's cname.  Returns the names of the ones
+    created, they aren't waited for.
+    """
+    size = int(get(env_config, 'standby.size', 0) if size is None else size)
+    if env_config.get('tier_name', 'WebServer') != 'WebServer':
+        raise Exception("Standby environments need cnames, %s isn't a WebServer tier" % (env_name, ))
+    cname_prefix = env_config.get('cname_prefix', None)
+    if not cname_prefix:
+        raise Exception("Standby environments for %s need a cname_prefix" % (env_name, ))
+
+    live_env_name = helper.environment_name_for_cname(cname_prefix)
+    live = helper.environment_snapshot().by_name.get(live_env_name) if live_env_name else None
+    version_label = live.get('VersionLabel') if live else None
+    option_settings = parse_option_settings(env_config.get('option_settings', {}))
+
+    created = []
+    taken_names = []
+    taken_cnames = []
+    for i in range(size - len(helper.standby_environments(env_name))):
+        standby_name = free_environment_name(helper, env_name, taken_names)
+        standby_cname = free_cname_prefix(helper, cname_prefix, taken_cnames)
+        if standby_name is None or standby_cname is None:
+            raise Exception("Unable to determine a name and cname for another standby of " + env_name)
+        taken_names.append(standby_name)
+        taken_cnames.append(standby_cname)
+        helper.create_environment(standby_name,
+                                  solution_stack_name=env_config.get('solution_stack_name'),
+                                  cname_prefix=standby_cname,
+                                  description=STANDBY_DESCRIPTION + env_name,
+                                  option_settings=option_settings,
+                                  version_label=version_label,
+                                  tier_name='WebServer',
+                                  tier_type=env_config.get('tier_type'),
+                                  tier_version=env_config.get('tier_version'))
+        created.append(standby_name)
+    return created
+
+
+def ready_standby(helper, env_name, solution_stack_name=None):
+    """
+    Returns the name of a Ready and Green standby environment
+    for env_name, or None.  Standbys created with another
+    solution stack can't be switched to this one, they're
+    skipped.
+    """
+    for env in sorted(helper.standby_environments(env_name), key=lambda env: env['EnvironmentName']):
+        if solution_stack_name and env.get('SolutionStackName') != solution_stack_name:
+            continue
+        if env['Status'] == 'Ready' and env.get('Health') == 'Green':
+            return env['EnvironmentName']
+    return None
+
+
+def claim_standby(helper, env_config, env_name, standby_name, version_label):
+    """
+    Deploys version_label to a standby environment, which
+    takes it out of env_name's pool, and then applies the
+    current option_settings and tier (the ones the pool was
+    filled with may have changed since)
+    """
+    out("Claiming standby environment " + standby_name)
+    helper.deploy_version(standby_name, version_label,
+                          description=env_config.get('description', None) or env_name)
+    helper.wait_for_environments(standby_name, status='Ready', version_label=version_label, include_deleted=False)
+    helper.update_environment(standby_name,
+                              description=env_config.get('description', None) or env_name,
+                              option_settings=parse_option_settings(env_config.get('option_settings', {})),
+                              tier_type=env_config.get('tier_type'),
+                              tier_name=env_config.get('tier_name'),
+                              tier_version=env_config.get('tier_version'))
+
+
+def content_key(content_hash):
+    """
+    Returns the s3 key (relative to the bucket path) archives
+    with the given sha256 are stored under
+    """
+    return content_hash + '.zip'
+
+
+def archive_digest(filename, multipart_threshold=None, part_size=MULTIPART_MIN_PART_SIZE):
+    """
+    Returns (sha256, etag) for an archive, where etag is
+    the ETag s3 will give the object once it's uploaded
+    with the given multipart settings
+    """
+    size = os.path.getsize(filename)
+    multipart = multipart_threshold is not None and size > multipart_threshold
+    part_size = max(int(part_size), MULTIPART_MIN_PART_SIZE)
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    part_digests = []
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(part_size)
+            if not data:
+                break
+            sha256.update(data)
+            if multipart:
+                part_digests.append(hashlib.md5(data).digest())
+            else:
+                md5.update(data)
+    if multipart:
+        etag = hashlib.md5(b''.join(part_digests)).hexdigest() + '-' + str(max(1, len(part_digests)))
+    else:
+        etag = md5.hexdigest()
+    return sha256.hexdigest(), etag
+
+
+class ArchiveMatcher(object):
+    """
+    Decides which files go in an archive from the
+    archive.includes and archive.excludes regex lists.  The
+    patterns are compiled once, calling the matcher with an
+    archive name returns whether the file should be added.
+    """
+
+    # patterns containing these may stop matching once more
+    # characters follow a directory name
+    PREFIX_UNSAFE = re.compile(r'\$|\\[ZbB]|\(\?[=!]')
+
+    def __init__(self, includes=None, excludes=None):
+        includes = includes or []
+        excludes = excludes or []
+        self.includes = _compile_patterns(includes)
+        self.excludes = _compile_patterns(excludes)
+        self.dir_excludes = _compile_patterns([p for p in excludes if not self.PREFIX_UNSAFE.search(p)])
+
+    def __call__(self, archive_name):
+        if self.excludes is not None and self.excludes.match(archive_name):
+            return False
+        if self.includes is not None:
+            return self.includes.match(archive_name) is not None
+        return True
+
+    def prune_dir(self, archive_dir):
+        """
+        Returns whether every file under the given directory
+        is excluded, meaning it doesn't need to be walked
+        """
+        return self.dir_excludes is not None \
+            and self.dir_excludes.match(os.path.join(archive_dir, '')) is not None
+
+
+class _PatternList(object):
+    """
+    Fallback for patterns that can't be joined into a
+    single regex
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [re.compile(p) for p in patterns]
+
+    def match(self, value):
+        for pattern in self.patterns:
+            m = pattern.match(value)
+            if m:
+                return m
+        return None
+
+
+def _compile_patterns(patterns):
+    """
+    Compiles a list of regexes into one object with a
+    match method, or returns None for an empty list
+    """
+    if not patterns:
+        return None
+    if not any(re.search(r'\\[1-9]|\(\?P=', p) for p in patterns):
+        try:
+            return re.compile('|'.join('(?:' + p + ')' for p in patterns))
+        except re.error:
+            pass
+    return _PatternList(patterns)
+
+
+def create_archive(directory, filename, config={}, ignore_predicate=None, ignored_files=['.git', '.svn'], workers=1,
+                   incremental=False):
     """
     Creates an archive from a directory and returns
-    the file that was created.
+    the file that was created.  When workers is greater
+    than one files are compressed in a thread pool and
+    written to the archive in walk order, the result is
+    byte for byte the same as a serial build.
+
+    When incremental is set a manifest of every file's
+    size, mtime and hash is kept next to the archive and
+    unchanged files are copied still compressed from the
+    previous archive instead of being compressed again.
+
+    The config files (archive.files) are written in the same
+    pass, replacing files of the same name in the directory.
+    """
+    import zipfile
+    manifest_file = os.path.join(os.path.dirname(os.path.abspath(filename)), ARCHIVE_MANIFEST)
+    previous = None
+    if incremental:
+        previous = _PreviousArchive.load(manifest_file, filename)
+    manifest = {}
+    try:
+        with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            out("Creating archive: " + str(filename))
+            # the previous archive sits next to the new one, often in
+            # the directory being archived
+            skip_files = [manifest_file]
+            if previous is not None:
+                skip_files.append(os.path.abspath(previous.zip_file.filename))
+            entries = _archive_entries(directory, filename, ignore_predicate, ignored_files,
+                                       skip_files=skip_files, skip_names=_config_file_names(config))
+            if incremental or (workers is not None and workers > 1):
+                _write_entries(zip_file, entries, workers or 1, previous=previous, manifest=manifest)
+            else:
+                for fullpath, archive_name in entries:
+                    out("Adding: " + str(archive_name))
+                    zip_file.write(fullpath, archive_name, zipfile.ZIP_DEFLATED)
+            _write_config_files(zip_file, filename, config)
+    finally:
+        if previous is not None:
+            previous.close()
+
+    if incremental:
+        with open(manifest_file, 'w') as f:
+            json.dump({'archive': os.path.basename(filename), 'files': manifest}, f)
+
+    return filename
+
+
+def write_archive(directory, fileobj, name, config=[], ignore_predicate=None, ignored_files=['.git', '.svn'],
+                  workers=1):
     """
-    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
-        root_len = len(os.path.abspath(directory))
+    Writes an archive of a directory, and the config files,
+    to a file object that only needs write() and tell() (see
+    EbsHelper.open_archive_stream).  Files larger than
+    ARCHIVE_STREAM_FILE_SIZE are compressed as they're written
+    so memory use doesn't grow with the size of the archive.
+    """
+    import zipfile
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        out("Streaming archive: " + str(name))
+        entries = _archive_entries(directory, name, ignore_predicate, ignored_files,
+                                   skip_names=_config_file_names(config))
+        if workers is not None and workers > 1:
+            _write_entries(zip_file, entries, workers, large_file_size=ARCHIVE_STREAM_FILE_SIZE)
+        else:
+            for fullpath, archive_name in entries:
+                out("Adding: " + str(archive_name))
+                zip_file.write(fullpath, archive_name, zipfile.ZIP_DEFLATED)
+        _write_config_files(zip_file, name, config)
 
-        # create it
-        out("Creating archive: " + str(filename))
-        for root, dirs, files in os.walk(directory, followlinks=True):
-            archive_root = os.path.abspath(root)[root_len + 1:]
-            for f in files:
-                fullpath = os.path.join(root, f)
-                archive_name = os.path.join(archive_root, f)
 
-                # ignore the file we're creating
-                if filename in fullpath:
+def _archive_entries(directory, filename, ignore_predicate=None, ignored_files=None, skip_files=[], skip_names=()):
+    """
+    Walks a directory and yields (fullpath, archive_name)
+    for every file that belongs in the archive.  Ignored
+    directories, and directories the predicate can prune
+    (see ArchiveMatcher.prune_dir), are not walked at all.
+    Files archived as one of skip_names are left out.
+    """
+    prune_dir = getattr(ignore_predicate, 'prune_dir', None)
+    root_len = len(os.path.abspath(directory))
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        archive_root = os.path.abspath(root)[root_len + 1:]
+
+        # prune directories
+        for d in dirs[:]:
+            archive_dir = os.path.join(archive_root, d)
+            if (ignored_files is not None and d in ignored_files) \
+                    or (prune_dir is not None and prune_dir(archive_dir)):
+                out("Skipping: " + str(archive_dir))
+                dirs.remove(d)
+
+        for f in files:
+            fullpath = os.path.join(root, f)
+            archive_name = os.path.join(archive_root, f)
+
+            # ignore the file we're creating and the config files
+            if filename in fullpath or os.path.abspath(fullpath) in skip_files or archive_name in skip_names:
+                continue
+
+            # ignored files
+            if ignored_files is not None and any(fullpath.endswith(name) for name in ignored_files):
+                out("Skipping: " + str(archive_name))
+                continue
+
+            # do predicate
+            if ignore_predicate is not None:
+                if not ignore_predicate(archive_name):
+                    out("Skipping: " + str(archive_name))
                     continue
 
-                # ignored files
-                if ignored_files is not None:
-                    for name in ignored_files:
-                        if fullpath.endswith(name):
-                            out("Skipping: " + str(name))
-                            continue
+            yield fullpath, archive_name
+
+
+def _file_sha1(fullpath):
+    """
+    Returns the sha1 hex digest of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(fullpath, 'rb') as f:
+        while True:
+            data = f.read(ARCHIVE_CHUNK_SIZE * 8)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def _deflate_file(fullpath, reuse_sha1=None):
+    """
+    Compresses a file the same way ZipFile.write does and
+    returns (crc, file_size, sha1, compressed_chunks).  If
+    the file hashes to reuse_sha1 nothing is compressed and
+    compressed_chunks is None.
+    """
+    if reuse_sha1 is not None:
+        sha1 = _file_sha1(fullpath)
+        if sha1 == reuse_sha1:
+            return None, None, sha1, None
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    sha1 = hashlib.sha1()
+    crc = 0
+    file_size = 0
+    chunks = []
+    with open(fullpath, 'rb') as f:
+        while True:
+            data = f.read(ARCHIVE_CHUNK_SIZE)
+            if not data:
+                break
+            file_size += len(data)
+            crc = zlib.crc32(data, crc)
+            sha1.update(data)
+            chunks.append(compressor.compress(data))
+    chunks.append(compressor.flush())
+    return crc, file_size, sha1.hexdigest(), chunks
+
+
+# Raw entry reads and writes lean on zipfile internals that
+# have been stable since python 3.8 (hence python_requires in
+# setup.py): ZipFile._writecheck, _didModify, start_dir,
+# _seekable and _strict_timestamps, ZipInfo.from_file's
+# strict_timestamps argument and the _FH_* header offsets.
+# Check them against new python releases.
+def _write_raw_entry(zip_file, zinfo, chunks):
+    """
+    Writes an already compressed entry to an open ZipFile,
+    zinfo must have its CRC and sizes filled in.  Mirrors
+    the bookkeeping ZipFile.open(..., 'w') does so the
+    bytes written match a regular write.
+    """
+    import zipfile
+    zinfo.flag_bits = 0x00
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    if zip_file._seekable:
+        zip_file.fp.seek(zip_file.start_dir)
+    zinfo.header_offset = zip_file.fp.tell()
+    zip_file._writecheck(zinfo)
+    zip_file._didModify = True
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    for chunk in chunks:
+        zip_file.fp.write(chunk)
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+
+
+def _read_raw_entry(zip_file, zinfo):
+    """
+    Yields the still compressed data of an entry in an
+    open ZipFile
+    """
+    import zipfile
+    fp = zip_file.fp
+    fp.seek(zinfo.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header for " + str(zinfo.filename))
+    header = struct.unpack(zipfile.structFileHeader, header)
+    fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        data = fp.read(min(remaining, ARCHIVE_CHUNK_SIZE * 8))
+        if not data:
+            raise zipfile.BadZipFile("Truncated entry " + str(zinfo.filename))
+        remaining -= len(data)
+        yield data
+
+
+class _PreviousArchive(object):
+    """
+    The archive and manifest left behind by the last
+    incremental build
+    """
+
+    def __init__(self, zip_file, files):
+        self.zip_file = zip_file
+        self.files = files
+
+    @classmethod
+    def load(cls, manifest_file, filename):
+        """
+        Returns the previous archive or None if there isn't
+        a usable one
+        """
+        import zipfile
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            archive = os.path.join(os.path.dirname(manifest_file), manifest['archive'])
+            if os.path.abspath(archive) == os.path.abspath(filename):
+                return None
+            return cls(zipfile.ZipFile(archive, 'r'), manifest['files'])
+        except (IOError, OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+    def lookup(self, archive_name):
+        """
+        Returns (record, zinfo) for an entry that can be
+        copied as is, or (None, None)
+        """
+        import zipfile
+        record = self.files.get(archive_name)
+        zinfo = self.zip_file.NameToInfo.get(archive_name)
+        if record is None or zinfo is None \
+                or zinfo.compress_type != zipfile.ZIP_DEFLATED \
+                or zinfo.flag_bits & 0x09 \
+                or zinfo.file_size != record['size']:
+            return None, None
+        return record, zinfo
+
+    def close(self):
+        self.zip_file.close()
 
-                # do predicate
-                if ignore_predicate is not None:
-                    if not ignore_predicate(archive_name):
-                        out("Skipping: " + str(archive_name))
-                        continue
 
+def _write_entries(zip_file, entries, workers, previous=None, manifest=None, large_file_size=None):
+    """
+    Compresses entries in a thread pool (zlib releases the
+    GIL) and writes them to the archive in order.  At most
+    a few files per worker are held in memory at once, files
+    larger than large_file_size are compressed as they're
+    written instead.  Entries unchanged since the previous
+    archive are copied from it without being compressed again.
+    """
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def _drain(limit):
+            while len(pending) > limit:
+                zinfo, st, future, record, old_zinfo = pending.popleft()
+                if future is not None:
+                    crc, file_size, sha1, chunks = future.result()
+                else:
+                    sha1, chunks = record['sha1'], None
+                if chunks is None:
+                    zinfo.CRC = old_zinfo.CRC
+                    zinfo.file_size = old_zinfo.file_size
+                    zinfo.compress_size = old_zinfo.compress_size
+                    chunks = _read_raw_entry(previous.zip_file, old_zinfo)
+                    out("Reusing: " + str(zinfo.filename))
+                else:
+                    zinfo.CRC = crc
+                    zinfo.file_size = file_size
+                    zinfo.compress_size = sum(len(chunk) for chunk in chunks)
+                    out("Adding: " + str(zinfo.filename))
+                _write_raw_entry(zip_file, zinfo, chunks)
+                if manifest is not None:
+                    manifest[zinfo.filename] = {'size': zinfo.file_size, 'mtime': st.st_mtime, 'sha1': sha1}
+
+        for fullpath, archive_name in entries:
+            st = os.stat(fullpath)
+            if large_file_size is not None and st.st_size > large_file_size:
+                _drain(0)
                 out("Adding: " + str(archive_name))
                 zip_file.write(fullpath, archive_name, zipfile.ZIP_DEFLATED)
-
-    return filename
+                continue
+            zinfo = zipfile.ZipInfo.from_file(fullpath, archive_name,
+                                              strict_timestamps=zip_file._strict_timestamps)
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            record, old_zinfo = (None, None)
+            if previous is not None:
+                record, old_zinfo = previous.lookup(zinfo.filename)
+            if record is not None and record['size'] == st.st_size and record['mtime'] == st.st_mtime:
+                future = None
+            elif record is not None and record['size'] == st.st_size:
+                future = executor.submit(_deflate_file, fullpath, record['sha1'])
+            else:
+                future = executor.submit(_deflate_file, fullpath)
+            pending.append((zinfo, st, future, record, old_zinfo))
+            _drain(workers * 2)
+        _drain(0)
 
 
 def add_config_files_to_archive(directory, filename, config={}):
     """
     Adds configuration files to an existing archive
     """
+    import zipfile
     with zipfile.ZipFile(filename, 'a') as zip_file:
-        for conf in config:
-            for conf, tree in list(conf.items()):
-                if 'yaml' in tree:
-                    content = yaml.dump(tree['yaml'], default_flow_style=False)
-                else:
-                    content = tree.get('content', '')
-                out("Adding file " + str(conf) + " to archive " + str(filename))
-                file_entry = zipfile.ZipInfo(conf)
-                file_entry.external_attr = tree.get('permissions', 0o644) << 16 
-                zip_file.writestr(file_entry, content)
+        _write_config_files(zip_file, filename, config)
 
     return filename
 
 
+def derive_archive(source, filename, config=[]):
+    """
+    Writes a copy of the source archive with the config files
+    (archive.files) added to filename.  Entries are copied
+    still compressed, the ones the config files replace are
+    left out.
+    """
+    import zipfile
+    names = _config_file_names(config)
+    with zipfile.ZipFile(source, 'r') as source_zip, \
+            zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        out("Copying archive " + str(source) + " to " + str(filename))
+        for old_zinfo in source_zip.infolist():
+            if old_zinfo.filename in names:
+                continue
+            if old_zinfo.flag_bits & 0x01:
+                raise Exception("Unable to copy encrypted entry " + str(old_zinfo.filename) + " from " + str(source))
+            zinfo = copy.copy(old_zinfo)
+            if hasattr(zipfile, '_strip_extra'):
+                # a zip64 extra field is added again if it's needed
+                zinfo.extra = zipfile._strip_extra(zinfo.extra, (1,))
+            _write_raw_entry(zip_file, zinfo, _read_raw_entry(source_zip, old_zinfo))
+        _write_config_files(zip_file, filename, config)
+    return filename
+
+
+def _config_file_names(config):
+    return set(name for conf in config for name in conf)
+
+
+def _config_file_content(tree):
+    """
+    Returns the content of an archive.files entry, yaml is
+    rendered once per entry
+    """
+    if 'yaml' not in tree:
+        return tree.get('content', '')
+    cached = _config_file_contents.get(id(tree))
+    if cached is None or cached[0] is not tree:
+        import yaml
+        cached = (tree, yaml.dump(tree['yaml'], default_flow_style=False))
+        _config_file_contents[id(tree)] = cached
+    return cached[1]
+
+
+def _write_config_files(zip_file, filename, config):
+    """
+    Writes the archive.files entries to an open ZipFile
+    """
+    import zipfile
+    for conf in config:
+        for conf, tree in list(conf.items()):
+            content = _config_file_content(tree)
+            out("Adding file " + str(conf) + " to archive " + str(filename))
+            file_entry = zipfile.ZipInfo(conf)
+            file_entry.external_attr = tree.get('permissions', 0o644) << 16
+            zip_file.writestr(file_entry, content)
+
+
+class MetadataCache(object):
+    """
+    Read through on disk cache for aws metadata that
+    rarely changes (bucket locations, application existence,
+    solution stacks).  Entries expire after ttl seconds, with
+    refresh set every entry is loaded again the first time
+    it's asked for.
+    """
+
+    def __init__(self, filename, ttl=DEFAULT_CACHE_TTL, refresh=False):
+        self.filename = os.path.expanduser(filename)
+        self.ttl = ttl
+        self.refresh = refresh
+        self._entries = None
+        self._refreshed = set()
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                with open(self.filename, 'r') as f:
+                    self._entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        # drop expired entries so the file doesn't keep growing
+        now = time()
+        for key in [key for key, entry in self._entries.items() if now - entry['time'] > self.ttl]:
+            del self._entries[key]
+        directory = os.path.dirname(self.filename)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_file = self.filename + '.' + str(os.getpid())
+            with open(temp_file, 'w') as f:
+                json.dump(self._entries, f)
+            os.rename(temp_file, self.filename)
+        except (IOError, OSError) as e:
+            out("Unable to write cache " + str(self.filename) + ": " + str(e))
+
+    def lookup(self, key):
+        """
+        Returns a cached value or None if it's missing,
+        expired or being refreshed
+        """
+        with self._lock:
+            if self.refresh and key not in self._refreshed:
+                return None
+            entry = self._load().get(key)
+            if entry is None or time() - entry['time'] > self.ttl:
+                return None
+            return entry['value']
+
+    def set(self, key, value):
+        with self._lock:
+            self._load()[key] = {'time': time(), 'value': value}
+            self._refreshed.add(key)
+            self._save()
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._load().pop(key, None) is not None:
+                self._save()
+
+    def get(self, key, loader):
+        """
+        Returns a cached value, calling loader and caching
+        its result if there isn't one
+        """
+        value = self.lookup(key)
+        if value is None:
+            value = loader()
+            self.set(key, value)
+        return value
+
+
+def _event_time_iso(event_date):
+    """
+    Returns an event's EventDate as an iso 8601 UTC
+    timestamp suitable for describe_events' start_time
+    """
+    if isinstance(event_date, (int, float)):
+        return (datetime(1970, 1, 1) + timedelta(seconds=event_date)).isoformat() + 'Z'
+    return str(event_date)
+
+
+class EventCursor(object):
+    """
+    Tails the events of a set of environments with a single
+    application wide describe_events call (following NextToken)
+    per poll.  The start time advances to the newest event seen,
+    and a bounded set of recent events drops the ones the
+    inclusive start time returns again.
+    """
+
+    def __init__(self, helper, environment_names=None, start_time=None, max_seen=MAX_SEEN_EVENTS):
+        self.helper = helper
+        self.environment_names = None
+        if environment_names is not None:
+            self.environment_names = set(environment_names)
+        self.start_time = start_time or datetime.utcnow().isoformat() + 'Z'
+        self.latest = None
+        self._seen = set()
+        self._seen_order = deque()
+        self._max_seen = max_seen
+
+    def _remember(self, key):
+        if key in self._seen:
+            return False
+        self._seen.add(key)
+        self._seen_order.append(key)
+        if len(self._seen_order) > self._max_seen:
+            self._seen.discard(self._seen_order.popleft())
+        return True
+
+    def poll(self):
+        """
+        Returns the events raised since the last poll, oldest first
+        """
+        new_events = []
+        next_token = None
+        while True:
+            (events, next_token) = self.helper.describe_application_events(
+                start_time=self.start_time, next_token=next_token)
+            for event in events:
+                if self.latest is None or event['EventDate'] > self.latest:
+                    self.latest = event['EventDate']
+                if self.environment_names is not None \
+                        and event.get('EnvironmentName') not in self.environment_names:
+                    continue
+                key = (event['EventDate'], event.get('EnvironmentName'), event.get('Severity'), event.get('Message'))
+                if self._remember(key):
+                    new_events.append(event)
+            if not next_token:
+                break
+        if self.latest is not None:
+            self.start_time = _event_time_iso(self.latest)
+        new_events.reverse()
+        return new_events
+
+
+class PollSchedule(object):
+    """
+    Decides how long wait_for_environments sleeps between
+    polls.  The first check comes quickly, the interval then
+    backs off (with jitter) while the environments sit in the
+    same transitional status, and drops back to min_interval
+    when their status changes or an event shows the
+    transition is nearly done.
+    """
+
+    def __init__(self, initial_delay=2, min_interval=5, max_interval=30, backoff=1.5, jitter=0.2,
+                 near_done_events=None):
+        self.initial_delay = float(initial_delay)
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        self.backoff = float(backoff)
+        self.jitter = float(jitter)
+        self.near_done = _compile_patterns(near_done_events if near_done_events is not None else NEAR_DONE_EVENTS)
+        self.interval = None
+        self._statuses = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a schedule from the poll node of the config
+        """
+        return cls(**dict((k, v) for k, v in list((config or {}).items()) if v is not None))
+
+    def next_delay(self):
+        """
+        Returns the number of seconds to sleep before the next poll
+        """
+        if self.interval is None:
+            self.interval = self.min_interval
+            return self.initial_delay
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def observe(self, environments, events):
+        """
+        Updates the schedule with the result of a poll
+        """
+        statuses = dict((env['EnvironmentName'], env['Status']) for env in environments)
+        if self.near_done is not None and any(self.near_done.match(event.get('Message') or '') for event in events):
+            self.interval = self.min_interval
+        elif statuses == self._statuses and all(status in TRANSITIONAL_STATUSES for status in statuses.values()):
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        else:
+            self.interval = self.min_interval
+        self._statuses = statuses
+
+
+class HealthCheckFailed(Exception):
+    """
+    Raised by wait_for_environments when an environment
+    breaks one of the HealthRules
+    """
+
+    def __init__(self, environment_name, reason):
+        super(HealthCheckFailed, self).__init__(str(environment_name) + ": " + reason)
+        self.environment_name = environment_name
+        self.reason = reason
+
+
+class HealthRules(object):
+    """
+    Decides when wait_for_environments gives up early: on
+    events with one of event_severities or matching one of
+    event_messages, on a Ready environment with one of the
+    (enhanced) health_statuses, or after red_samples Ready
+    and Red polls in a row.  rollback is for the commands,
+    see rollback_versions.
+    """
+
+    def __init__(self, event_severities=None, event_messages=None, health_statuses=None,
+                 red_samples=MAX_RED_SAMPLES, rollback=False):
+        self.event_severities = set(event_severities or [])
+        self.event_messages = _compile_patterns(event_messages)
+        self.health_statuses = set(health_statuses or [])
+        self.red_samples = int(red_samples)
+        self.rollback = bool(rollback)
+        self._red = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates the rules from the fail_fast node of the config
+        """
+        return cls(**dict((k, v) for k, v in list((config or {}).items()) if v is not None))
+
+    def check_environment(self, env):
+        """
+        Raises HealthCheckFailed if a polled environment
+        breaks a rule
+        """
+        env_name = env['EnvironmentName']
+        if env['Status'] != 'Ready':
+            self._red.pop(env_name, None)
+            return
+        if env.get('HealthStatus') in self.health_statuses:
+            raise HealthCheckFailed(env_name, "health is " + str(env['HealthStatus']))
+        if env['Health'] != 'Red':
+            self._red.pop(env_name, None)
+            return
+        self._red[env_name] = self._red.get(env_name, 0) + 1
+        if self._red[env_name] >= self.red_samples:
+            raise HealthCheckFailed(env_name, "Ready and Red for " + str(self._red[env_name]) + " polls")
+
+    def check_events(self, events):
+        """
+        Raises HealthCheckFailed for the first event that
+        breaks a rule
+        """
+        for event in events:
+            message = event.get('Message') or ''
+            if event.get('Severity') in self.event_severities \
+                    or (self.event_messages is not None and self.event_messages.match(message)):
+                raise HealthCheckFailed(event.get('EnvironmentName'),
+                                        "[" + str(event.get('Severity')) + "] " + message)
+
+
+class EnvironmentSnapshot(object):
+    """
+    An application's environments as returned by a single
+    describe_environments call, indexed by name and cname
+    prefix.  Terminated environments are left out.
+    """
+
+    def __init__(self, environments):
+        self.environments = environments
+        self.by_name = {}
+        self.by_cname_prefix = {}
+        for env in environments:
+            if env['Status'] == 'Terminated':
+                continue
+            self.by_name[env['EnvironmentName']] = env
+            if env.get('CNAME'):
+                self.by_cname_prefix[env['CNAME'].lower().split('.')[0]] = env
+
+    def exists(self, env_name):
+        return env_name in self.by_name
+
+    def name_for_cname(self, cname_prefix):
+        env = self.by_cname_prefix.get(cname_prefix.lower())
+        if env is None:
+            return None
+        return env['EnvironmentName']
+
+
+class ApplicationVersion(namedtuple('ApplicationVersion',
+                                    ['label', 'date_created', 'description', 's3_bucket', 's3_key'])):
+    """
+    The parts of an application version we use, date_created
+    is a unix timestamp
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, version):
+        bundle = version.get('SourceBundle') or {}
+        return cls(version['VersionLabel'], parse_timestamp(version.get('DateCreated')),
+                   version.get('Description'), bundle.get('S3Bucket'), bundle.get('S3Key'))
+
+
+def parse_timestamp(value):
+    """
+    Returns a unix timestamp for a number or an iso 8601
+    date (with or without a time) as found in api responses
+    and on the command line
+    """
+    if value is None:
+        return 0.0
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).rstrip('Z')
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return (datetime.strptime(value, fmt) - datetime(1970, 1, 1)).total_seconds()
+        except ValueError:
+            pass
+    raise ValueError("Unable to parse date: " + value)
+
+
+def newest_versions(versions, count):
+    """
+    Returns the count newest versions, newest first,
+    without sorting all of them
+    """
+    return heapq.nlargest(count, versions, key=lambda version: version.date_created)
+
+
+def versions_beyond_newest(versions, count):
+    """
+    Yields the versions that aren't among the count newest,
+    as soon as each is known to be older than count others
+    """
+    newest = []
+    for i, version in enumerate(versions):
+        heapq.heappush(newest, (version.date_created, i, version))
+        if len(newest) > count:
+            yield heapq.heappop(newest)[2]
+
+
+def _is_throttling(e):
+    """
+    Returns whether an aws error means we're being throttled
+    """
+    return getattr(e, 'error_code', None) in ('Throttling', 'ThrottlingException', 'RequestLimitExceeded') \
+        or 'Throttling' in str(getattr(e, 'body', '') or '')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, acquire() blocks until a token is
+    available.  The rate halves when throttled() is called and
+    creeps back up (to max_rate) as calls succeed.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.2, max_rate=None):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.tokens = self.burst
+        self.updated = time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class ApiStats(object):
+    """
+    Thread safe counters for aws api calls: calls, errors,
+    throttles and retries per service and operation along
+    with a latency histogram (LATENCY_BUCKETS are the upper
+    bounds in seconds, the last bucket counts slower calls).
+    """
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def _operation(self, service, operation):
+        key = (service, operation)
+        stats = self._operations.get(key)
+        if stats is None:
+            stats = self._operations[key] = {
+                'service': service, 'operation': operation, 'calls': 0, 'errors': 0, 'throttles': 0,
+                'retries': 0, 'total_time': 0.0, 'max_time': 0.0,
+                'histogram': [0] * (len(self.LATENCY_BUCKETS) + 1)}
+        return stats
+
+    def record(self, service, operation, elapsed, error=False, throttled=False):
+        with self._lock:
+            stats = self._operation(service, operation)
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            bucket = 0
+            while bucket < len(self.LATENCY_BUCKETS) and elapsed > self.LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            stats['histogram'][bucket] += 1
+            if error or throttled:
+                stats['errors'] += 1
+            if throttled:
+                stats['throttles'] += 1
+
+    def retried(self, service, operation):
+        """
+        Counts a call we're about to make again
+        """
+        with self._lock:
+            self._operation(service, operation)['retries'] += 1
+
+    def operations(self):
+        """
+        Returns a copy of the counters for every operation
+        called, busiest first
+        """
+        with self._lock:
+            result = []
+            for stats in self._operations.values():
+                stats = dict(stats)
+                stats['histogram'] = list(stats['histogram'])
+                result.append(stats)
+        result.sort(key=lambda stats: (-stats['calls'], stats['service'], stats['operation']))
+        return result
+
+    def total(self, name='calls', service=None):
+        """
+        Returns the total of one of the counters, optionally
+        for a single service
+        """
+        return sum(stats[name] for stats in self.operations() if service is None or stats['service'] == service)
+
+    def percentile(self, stats, fraction):
+        """
+        Returns the latency bucket bound below which fraction
+        of an operation's calls fell (capped at max_time)
+        """
+        target = stats['calls'] * fraction
+        seen = 0
+        for bucket, count in enumerate(stats['histogram']):
+            seen += count
+            if seen >= target and count:
+                if bucket < len(self.LATENCY_BUCKETS):
+                    return min(self.LATENCY_BUCKETS[bucket], stats['max_time'])
+                break
+        return stats['max_time']
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def report(self):
+        """
+        Prints a table of the counters
+        """
+        operations = self.operations()
+        if not operations:
+            out("No aws api calls were made")
+            return
+        row = "%-10s %-32s %7s %7s %9s %8s %9s %9s %9s"
+        out(row % ('service', 'operation', 'calls', 'errors', 'throttled', 'retries', 'avg ms', 'p95 ms', 'max ms'))
+        for stats in operations:
+            out(row % (stats['service'], stats['operation'], stats['calls'], stats['errors'], stats['throttles'],
+                       stats['retries'], int(stats['total_time'] / max(1, stats['calls']) * 1000),
+                       int(self.percentile(stats, 0.95) * 1000), int(stats['max_time'] * 1000)))
+        out(row % ('total', '', self.total('calls'), self.total('errors'), self.total('throttles'),
+                   self.total('retries'), '', '', ''))
+
+
+def _s3_operation(method, bucket, key, query_args):
+    """
+    Returns the s3 api operation name for a request
+    """
+    query = set(arg.split('=', 1)[0] for arg in (query_args or '').split('&') if arg)
+    if key:
+        if 'partNumber' in query:
+            return 'UploadPart'
+        if 'uploads' in query:
+            return 'CreateMultipartUpload'
+        if 'uploadId' in query:
+            return {'POST': 'CompleteMultipartUpload', 'DELETE': 'AbortMultipartUpload'}.get(method, 'ListParts')
+        if not query:
+            return {'GET': 'GetObject', 'PUT': 'PutObject', 'HEAD': 'HeadObject',
+                    'DELETE': 'DeleteObject'}.get(method, method + ' object')
+    elif bucket:
+        if 'location' in query:
+            return 'GetBucketLocation'
+        if 'uploads' in query:
+            return 'ListMultipartUploads'
+        if 'delete' in query:
+            return 'DeleteObjects'
+        if not query:
+            return {'GET': 'ListObjects', 'PUT': 'CreateBucket', 'HEAD': 'HeadBucket',
+                    'DELETE': 'DeleteBucket'}.get(method, method + ' bucket')
+    else:
+        return 'ListBuckets'
+    return method + ' ' + '&'.join(sorted(query))
+
+
+def instrument_connection(connection, service, stats):
+    """
+    Records every request a boto connection makes in stats.
+    The connection's request method is wrapped rather than
+    the connection proxied, buckets and keys hold on to the
+    connection and make their requests through it too.
+    """
+    if service == 's3':
+        make_request = connection.make_request
+
+        def _make_request(method, bucket='', key='', *args, **kwargs):
+            # make_request(method, bucket, key, headers, data, query_args, ...)
+            query_args = kwargs.get('query_args', args[2] if len(args) > 2 else None)
+            operation = _s3_operation(method, bucket, key, query_args)
+            started = time()
+            try:
+                response = make_request(method, bucket, key, *args, **kwargs)
+            except Exception:
+                stats.record(service, operation, time() - started, error=True)
+                raise
+            status = getattr(response, 'status', 200)
+            stats.record(service, operation, time() - started, error=status >= 400, throttled=status == 503)
+            return response
+        connection.make_request = _make_request
+    else:
+        get_response = connection._get_response
+
+        def _get_response(action, *args, **kwargs):
+            started = time()
+            try:
+                response = get_response(action, *args, **kwargs)
+            except Exception as e:
+                stats.record(service, action, time() - started, error=True, throttled=_is_throttling(e))
+                raise
+            stats.record(service, action, time() - started)
+            return response
+        connection._get_response = _get_response
+    return connection
+
+
+class ArchiveUploadStream(object):
+    """
+    Write only file object that sends what's written to it
+    to s3 as a multipart upload, part_size bytes at a time
+    with up to workers parts in flight.  write() blocks while
+    every worker is busy so at most workers + 1 parts are held
+    in memory.  close() completes the upload, abort() cancels
+    it.  sha256 is the hash of everything written.
+    """
+
+    def __init__(self, helper, bucket, key_name, metadata=None, part_size=MULTIPART_MIN_PART_SIZE, workers=4):
+        from concurrent.futures import ThreadPoolExecutor
+        self.helper = helper
+        self.key_name = key_name
+        self.part_size = max(int(part_size), MULTIPART_MIN_PART_SIZE)
+        self.mp = bucket.initiate_multipart_upload(key_name, metadata=metadata or {})
+        self._buffer = bytearray()
+        self._position = 0
+        self._hash = hashlib.sha256()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._slots = threading.Semaphore(max(1, workers))
+        self._futures = []
+        self._connections = threading.local()
+        self._parent = current_span()
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        self._hash.update(data)
+        self._position += len(data)
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._send(part)
+        return len(data)
+
+    def _send(self, data):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        future = self._executor.submit(self._upload_part, part_number, data)
+        future.add_done_callback(lambda future: self._slots.release())
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, data):
+        import io
+        with span('upload.part', parent=self._parent, part=part_number, bytes=len(data)):
+            for attempt in range(MULTIPART_RETRIES):
+                try:
+                    if not hasattr(self._connections, 'bucket'):
+                        self._connections.bucket = self.helper._connect_s3().get_bucket(
+                            self.helper.aws.bucket, validate=False)
+                    part_mp = copy.copy(self.mp)
+                    part_mp.bucket = self._connections.bucket
+                    part_mp.upload_part_from_file(io.BytesIO(data), part_number, size=len(data))
+                    out("Uploaded part " + str(part_number) + " of " + str(self.key_name)
+                        + " (" + str(len(data)) + " bytes)")
+                    return
+                except Exception as e:
+                    if attempt + 1 >= MULTIPART_RETRIES:
+                        raise
+                    self.helper.api_stats.retried('s3', 'UploadPart')
+                    out("Retrying part " + str(part_number) + " of " + str(self.key_name) + ": " + str(e))
+                    sleep(2 ** attempt)
+
+    def close(self):
+        """
+        Sends what's left and completes the upload
+        """
+        if self._buffer or not self._futures:
+            self._send(bytes(self._buffer))
+            self._buffer = bytearray()
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True)
+        out("Sent " + str(len(self._futures)) + " parts (" + str(self._position) + " bytes), completing upload")
+        with span('upload.complete'):
+            self.mp.complete_upload()
+
+    def abort(self):
+        """
+        Stops sending parts and cancels the upload
+        """
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        try:
+            self.mp.cancel_upload()
+        except Exception as e:
+            out("Unable to cancel upload of " + str(self.key_name) + ": " + str(e))
+
+
 class AwsCredentials:
     """
-    Class for holding AwsCredentials
+    Class for holding AwsCredentials, account identifies who
+    they belong to when the keys don't (the role assumed for
+    temporary credentials)
     """
 
-    def __init__(self, access_key, secret_key, security_token, region, bucket, bucket_path):
+    def __init__(self, access_key, secret_key, security_token, region, bucket, bucket_path, account=None):
         self.access_key = access_key
         self.secret_key = secret_key
         self.security_token = security_token
         self.bucket = bucket
         self.region = region
         self.bucket_path = bucket_path
+        self.account = account
         if not self.bucket_path.endswith('/'):
             self.bucket_path += '/'
 
@@ -227,42 +2012,132 @@ class EbsHelper(object):
     Class for helping with ebs
     """
 
-    def __init__(self, aws, wait_time_secs, app_name=None,):
+    def __init__(self, aws, wait_time_secs, app_name=None, cache=None, poll_schedule=PollSchedule, api_stats=None,
+                 connections=None, health_rules=HealthRules):
         """
-        Creates the EbsHelper
+        Creates the EbsHelper, poll_schedule and health_rules are
+        called to create the PollSchedule and HealthRules for each
+        wait.  Api calls are counted in
+        api_stats (an ApiStats).  connections opens the beanstalk
+        and s3 connections (connect_beanstalk(aws) and
+        connect_s3(aws), see benchmarks/simulator.py), boto's are
+        used by default.
         """
         self.aws = aws
-        self.ebs = connect_to_region(aws.region, aws_access_key_id=aws.access_key,
-                                     aws_secret_access_key=aws.secret_key,
-                                     security_token=aws.security_token)
-        self.s3 = S3Connection(
-            aws_access_key_id=aws.access_key, 
-            aws_secret_access_key=aws.secret_key, 
-            security_token=aws.security_token,
-            host=(lambda r: 's3.amazonaws.com' if r == 'us-east-1' else 's3-' + r + '.amazonaws.com')(aws.region))
+        self.connections = connections
+        self.api_stats = api_stats if api_stats is not None else ApiStats()
+        self.cache = cache
+        self.poll_schedule = poll_schedule
+        self.health_rules = health_rules
+        self._local = threading.local()
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._s3 = None
         self.app_name = app_name
         self.wait_time_secs = wait_time_secs
 
+    @property
+    def ebs(self):
+        """
+        The beanstalk connection, each thread gets its own
+        since boto connections can't be shared between threads
+        """
+        connection = getattr(self._local, 'ebs', None)
+        if connection is None:
+            if self.connections is not None:
+                connection = self.connections.connect_beanstalk(self.aws)
+            else:
+                from boto.beanstalk import connect_to_region
+                connection = connect_to_region(self.aws.region, aws_access_key_id=self.aws.access_key,
+                                               aws_secret_access_key=self.aws.secret_key,
+                                               security_token=self.aws.security_token)
+            self._local.ebs = instrument_connection(connection, 'beanstalk', self.api_stats)
+        return connection
+
+    @property
+    def s3(self):
+        """
+        The s3 connection, opened the first time it's used
+        """
+        if self._s3 is None:
+            self._s3 = self._connect_s3()
+        return self._s3
+
+    def _connect_s3(self):
+        """
+        Opens a new s3 connection
+        """
+        if self.connections is not None:
+            return instrument_connection(self.connections.connect_s3(self.aws), 's3', self.api_stats)
+        from boto.s3.connection import S3Connection
+        return instrument_connection(S3Connection(
+            aws_access_key_id=self.aws.access_key,
+            aws_secret_access_key=self.aws.secret_key,
+            security_token=self.aws.security_token,
+            host=(lambda r: 's3.amazonaws.com' if r == 'us-east-1' else 's3-' + r + '.amazonaws.com')(self.aws.region)),
+            's3', self.api_stats)
+
+    @traced('swap_environment_cnames', 'from_environment', 'to_environment')
     def swap_environment_cnames(self, from_env_name, to_env_name):
         """
         Swaps cnames for an environment
         """
         self.ebs.swap_environment_cnames(source_environment_name=from_env_name,
                                          destination_environment_name=to_env_name)
+        self.invalidate_environments()
+
+    def _cache_key(self, name):
+        """
+        Returns a cache key scoped to the region, account
+        and bucket this helper works with
+        """
+        # assumed role credentials change every session, the
+        # role they're for doesn't
+        account = 'default'
+        if self.aws.account:
+            account = self.aws.account
+        elif self.aws.access_key:
+            account = hashlib.sha1(self.aws.access_key.encode('utf-8')).hexdigest()[:16]
+        return '|'.join([str(self.aws.region), account, str(self.aws.bucket), name])
+
+    def _cached(self, name, loader):
+        """
+        Returns loader() through the metadata cache if there is one
+        """
+        if self.cache is None:
+            return loader()
+        return self.cache.get(self._cache_key(name), loader)
 
-    def upload_archive(self, filename, key, auto_create_bucket=True):
+    def get_bucket(self):
         """
-        Uploads an application archive version to s3
+        Returns the archive bucket, creating it if it
+        doesn't exist
         """
+        from boto.exception import S3ResponseError
+        expected_location = '' if self.aws.region == 'us-east-1' else self.aws.region
         try:
-            bucket = self.s3.get_bucket(self.aws.bucket)
-            if ((
-                  self.aws.region != 'us-east-1' and self.aws.region != 'eu-west-1') and bucket.get_location() != self.aws.region) or (
-                  self.aws.region == 'us-east-1' and bucket.get_location() != '') or (
-                  self.aws.region == 'eu-west-1' and bucket.get_location() != 'eu-west-1'):
-                raise Exception("Existing bucket doesn't match region")
+            location = self._cached('bucket_location', lambda: self.s3.get_bucket(
+                self.aws.bucket, validate=False).get_location())
         except S3ResponseError:
-            bucket = self.s3.create_bucket(self.aws.bucket, location=self.aws.region)
+            return self.s3.create_bucket(self.aws.bucket, location=self.aws.region)
+        if location != expected_location:
+            raise Exception("Existing bucket doesn't match region")
+        return self.s3.get_bucket(self.aws.bucket, validate=False)
+
+    def upload_archive(self, filename, key, auto_create_bucket=True, multipart_threshold=None,
+                       part_size=MULTIPART_MIN_PART_SIZE, workers=4, content_hash=None, etag=None):
+        """
+        Uploads an application archive version to s3, archives
+        larger than multipart_threshold bytes are uploaded in
+        parallel parts under their content_key() (so a failed
+        upload can be resumed whatever the next version label)
+        and checked against etag.  Returns the key (relative to
+        the bucket path) the archive was uploaded to.
+        """
+        bucket = self.get_bucket()
+        metadata = {'time': str(time())}
+        if content_hash is not None:
+            metadata['hash'] = content_hash
 
         def __report_upload_progress(sent, total):
             if not sent:
@@ -273,18 +2148,132 @@ class EbsHelper(object):
                 + " (" + str(int(float(max(1, sent)) / float(total) * 100)) + "%)")
 
         # upload the new version
-        k = Key(bucket)
-        k.key = self.aws.bucket_path + key
-        k.set_metadata('time', str(time()))
-        k.set_contents_from_filename(filename, cb=__report_upload_progress, num_cb=10)
+        with span('upload', key=self.aws.bucket_path + key, bytes=os.path.getsize(filename)):
+            if multipart_threshold is not None and os.path.getsize(filename) > multipart_threshold:
+                if content_hash is None:
+                    content_hash, etag = archive_digest(filename, multipart_threshold=multipart_threshold,
+                                                        part_size=part_size)
+                    metadata['hash'] = content_hash
+                key = content_key(content_hash)
+                self.upload_archive_multipart(bucket, filename, self.aws.bucket_path + key, metadata,
+                                              part_size=part_size, workers=workers, etag=etag)
+                return key
+            k = bucket.new_key(self.aws.bucket_path + key)
+            for name, value in list(metadata.items()):
+                k.set_metadata(name, value)
+            k.set_contents_from_filename(filename, cb=__report_upload_progress, num_cb=10)
+        return key
+
+    def open_archive_stream(self, key, part_size=MULTIPART_MIN_PART_SIZE, workers=4):
+        """
+        Returns an ArchiveUploadStream that uploads an
+        application archive to s3 as it's written
+        """
+        return ArchiveUploadStream(self, self.get_bucket(), self.aws.bucket_path + key,
+                                   metadata={'time': str(time())}, part_size=part_size, workers=workers)
+
+    def upload_archive_multipart(self, bucket, filename, key_name, metadata,
+                                 part_size=MULTIPART_MIN_PART_SIZE, workers=4, etag=None):
+        """
+        Uploads a file to s3 as a multipart upload with parts
+        sent in parallel.  key_name should be derived from the
+        content (see content_key), an unfinished upload of that
+        key left by an earlier failure whose parts all match the
+        file is resumed without sending those parts again.  Other
+        uploads are left alone.  The finished object is checked
+        against etag (see archive_digest).
+        """
+        size = os.path.getsize(filename)
+        part_size = max(int(part_size), MULTIPART_MIN_PART_SIZE)
+        part_count = max(1, int(math.ceil(size / float(part_size))))
+
+        def _part_matches(part):
+            offset = (part.part_number - 1) * part_size
+            length = min(part_size, size - offset)
+            if part.size != length:
+                return False
+            with open(filename, 'rb') as fp:
+                fp.seek(offset)
+                return part.etag.strip('"') == hashlib.md5(fp.read(length)).hexdigest()
+
+        # find an upload of this content to resume, one with other
+        # parts (say a different part size) belongs to someone else
+        mp = None
+        uploaded = set()
+        for upload in bucket.get_all_multipart_uploads(prefix=key_name):
+            if upload.key_name != key_name:
+                continue
+            parts = list(upload)
+            if all(part.part_number <= part_count and _part_matches(part) for part in parts) \
+                    and (mp is None or len(parts) > len(uploaded)):
+                mp = upload
+                uploaded = set(part.part_number for part in parts)
+        if mp is not None:
+            out("Resuming upload of " + str(key_name) + ", " + str(len(uploaded)) + " parts already uploaded")
+        else:
+            mp = bucket.initiate_multipart_upload(key_name, metadata=metadata)
+
+        from concurrent.futures import ThreadPoolExecutor
+        connections = threading.local()
+        parent = current_span()
+
+        def _upload_part(part_number):
+            if part_number in uploaded:
+                return False
+            offset = (part_number - 1) * part_size
+            length = min(part_size, size - offset)
+            with open(filename, 'rb') as fp, span('upload.part', parent=parent, part=part_number, bytes=length):
+                for attempt in range(MULTIPART_RETRIES):
+                    try:
+                        if not hasattr(connections, 'bucket'):
+                            connections.bucket = self._connect_s3().get_bucket(self.aws.bucket, validate=False)
+                        # the upload, sent over this thread's connection
+                        part_mp = copy.copy(mp)
+                        part_mp.bucket = connections.bucket
+                        fp.seek(offset)
+                        part_mp.upload_part_from_file(fp, part_number, size=length)
+                        return True
+                    except Exception as e:
+                        if attempt + 1 >= MULTIPART_RETRIES:
+                            raise
+                        self.api_stats.retried('s3', 'UploadPart')
+                        out("Retrying part " + str(part_number) + " of " + str(key_name) + ": " + str(e))
+                        sleep(2 ** attempt)
+
+        sent = 0
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [(number, executor.submit(_upload_part, number)) for number in range(1, part_count + 1)]
+            try:
+                for part_number, future in futures:
+                    if future.result():
+                        sent += 1
+                    out("Uploaded part " + str(part_number) + " of " + str(part_count)
+                        + " (" + str(int(float(part_number) / float(part_count) * 100)) + "%)")
+            except Exception:
+                for part_number, future in futures:
+                    future.cancel()
+                out("Upload of " + str(key_name) + " failed, run again to resume from the parts already uploaded")
+                raise
+
+        out("Sent " + str(sent) + " of " + str(part_count) + " parts, completing upload")
+        with span('upload.complete'):
+            mp.complete_upload()
+            uploaded_key = bucket.get_key(key_name)
+        if uploaded_key is None or int(uploaded_key.size) != size \
+                or (etag is not None and uploaded_key.etag.strip('"') != etag):
+            raise Exception("Uploaded " + str(key_name) + " doesn't match " + str(filename))
+        return key_name
 
     def list_available_solution_stacks(self):
         """
         Returns a list of available solution stacks
         """
-        stacks = self.ebs.list_available_solution_stacks()
-        return stacks['ListAvailableSolutionStacksResponse']['ListAvailableSolutionStacksResult']['SolutionStacks']
+        def _list():
+            stacks = self.ebs.list_available_solution_stacks()
+            return stacks['ListAvailableSolutionStacksResponse']['ListAvailableSolutionStacksResult']['SolutionStacks']
+        return self._cached('solution_stacks', _list)
 
+    @traced('create_application')
     def create_application(self, description=None):
         """
         Creats an application and sets the helpers current
@@ -292,7 +2281,11 @@ class EbsHelper(object):
         """
         out("Creating application " + str(self.app_name))
         self.ebs.create_application(self.app_name, description=description)
+        self.invalidate_environments()
+        if self.cache is not None:
+            self.cache.set(self._cache_key('application_exists:' + str(self.app_name)), True)
 
+    @traced('delete_application')
     def delete_application(self):
         """
         Creats an application and sets the helpers current
@@ -300,14 +2293,25 @@ class EbsHelper(object):
         """
         out("Deleting application " + str(self.app_name))
         self.ebs.delete_application(self.app_name, terminate_env_by_force=True)
+        self.invalidate_environments()
+        if self.cache is not None:
+            self.cache.invalidate(self._cache_key('application_exists:' + str(self.app_name)))
 
     def application_exists(self):
         """
-        Returns whether or not the given app_name exists
+        Returns whether or not the given app_name exists,
+        only applications that exist are cached
         """
+        key = self._cache_key('application_exists:' + str(self.app_name))
+        if self.cache is not None and self.cache.lookup(key):
+            return True
         response = self.ebs.describe_applications(application_names=[self.app_name])
-        return len(response['DescribeApplicationsResponse']['DescribeApplicationsResult']['Applications']) > 0
+        exists = len(response['DescribeApplicationsResponse']['DescribeApplicationsResult']['Applications']) > 0
+        if exists and self.cache is not None:
+            self.cache.set(key, True)
+        return exists
 
+    @traced('create_environment', 'environment')
     def create_environment(self, env_name, version_label=None,
                            solution_stack_name=None, cname_prefix=None, description=None,
                            option_settings=None, tier_name='WebServer', tier_type='Standard', tier_version='1.1'):
@@ -324,37 +2328,63 @@ class EbsHelper(object):
                                     tier_type=tier_type,
                                     tier_name=tier_name,
                                     tier_version=tier_version)
+        self.invalidate_environments()
 
     def environment_exists(self, env_name):
         """
         Returns whether or not the given environment exists
         """
-        response = self.ebs.describe_environments(application_name=self.app_name, environment_names=[env_name],
-                                                  include_deleted=False)
-        return len(response['DescribeEnvironmentsResponse']['DescribeEnvironmentsResult']['Environments']) > 0 \
-               and response['DescribeEnvironmentsResponse']['DescribeEnvironmentsResult']['Environments'][0][
-                       'Status'] != 'Terminated'
+        return self.environment_snapshot().exists(env_name)
 
+    @traced('rebuild_environment', 'environment')
     def rebuild_environment(self, env_name):
         """
         Rebuilds an environment
         """
         out("Rebuilding " + str(env_name))
         self.ebs.rebuild_environment(environment_name=env_name)
+        self.invalidate_environments()
 
     def get_environments(self):
         """
-        Returns the environments
+        Returns the environments, this always calls
+        describe_environments and refreshes the snapshot
         """
+        return self._fetch_snapshot().environments
+
+    def _fetch_snapshot(self):
         response = self.ebs.describe_environments(application_name=self.app_name, include_deleted=False)
-        return response['DescribeEnvironmentsResponse']['DescribeEnvironmentsResult']['Environments']
+        snapshot = EnvironmentSnapshot(
+            response['DescribeEnvironmentsResponse']['DescribeEnvironmentsResult']['Environments'])
+        self._snapshot = snapshot
+        return snapshot
 
+    def environment_snapshot(self):
+        """
+        Returns an EnvironmentSnapshot, it's fetched once and
+        kept until this helper changes an environment
+        """
+        with self._snapshot_lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = self._fetch_snapshot()
+        return snapshot
+
+    def invalidate_environments(self):
+        """
+        Drops the environment snapshot
+        """
+        self._snapshot = None
+
+    @traced('delete_environment', 'environment')
     def delete_environment(self, environment_name):
         """
         Deletes an environment
         """
         self.ebs.terminate_environment(environment_name=environment_name, terminate_resources=True)
+        self.invalidate_environments()
 
+    @traced('update_environment', 'environment')
     def update_environment(self, environment_name, description=None, option_settings=[], tier_type=None, tier_name=None,
                            tier_version='1.0'):
         """
@@ -377,69 +2407,199 @@ class EbsHelper(object):
             tier_type=tier_type,
             tier_name=tier_name,
             tier_version=tier_version)
+        self.invalidate_environments()
 
     def environment_name_for_cname(self, env_cname):
         """
         Returns an environment name for the given cname
         """
-        envs = self.get_environments()
-        for env in envs:
-            if env['Status'] != 'Terminated' \
-                and 'CNAME' in env \
-                and env['CNAME'] \
-                and env['CNAME'].lower().startswith(env_cname.lower() + '.'):
-                return env['EnvironmentName']
-        return None
+        return self.environment_snapshot().name_for_cname(env_cname)
 
-    def deploy_version(self, environment_name, version_label):
+    @traced('deploy_version', 'environment', 'version')
+    def deploy_version(self, environment_name, version_label, description=None):
         """
         Deploys a version to an environment
         """
         out("Deploying " + str(version_label) + " to " + str(environment_name))
-        self.ebs.update_environment(environment_name=environment_name, version_label=version_label)
+        self.ebs.update_environment(environment_name=environment_name, version_label=version_label,
+                                    description=description)
+        self.invalidate_environments()
+
+    def standby_environments(self, env_name):
+        """
+        Returns the standby environments kept for env_name
+        (see fill_standby_pool)
+        """
+        description = STANDBY_DESCRIPTION + env_name
+        return [env for env in self.environment_snapshot().by_name.values()
+                if env.get('Description') == description]
 
     def get_versions(self):
         """
         Returns the versions available
         """
-        response = self.ebs.describe_application_versions(application_name=self.app_name)
-        return response['DescribeApplicationVersionsResponse']['DescribeApplicationVersionsResult']['ApplicationVersions']
+        return list(self._iter_version_pages())
+
+    def _iter_version_pages(self, page_size=VERSION_PAGE_SIZE):
+        """
+        Yields the raw application versions, fetching them
+        page_size at a time
+        """
+        # boto's describe_application_versions doesn't expose
+        # MaxRecords and NextToken so the request is made directly
+        params = {'ApplicationName': self.app_name, 'MaxRecords': page_size}
+        while True:
+            response = self.ebs._get_response('DescribeApplicationVersions', params)
+            result = response['DescribeApplicationVersionsResponse']['DescribeApplicationVersionsResult']
+            for version in result['ApplicationVersions']:
+                yield version
+            next_token = result.get('NextToken')
+            if not next_token:
+                break
+            params['NextToken'] = next_token
 
-    def create_application_version(self, version_label, key):
+    def iter_versions(self, label=None, since=None, until=None, page_size=VERSION_PAGE_SIZE):
         """
-        Creates an application version
+        Yields ApplicationVersion records as they are paged in,
+        optionally only those whose label matches the label
+        regex or that were created between since and until
+        (unix timestamps)
+        """
+        label_regex = re.compile(label) if label else None
+        for version in self._iter_version_pages(page_size=page_size):
+            record = ApplicationVersion.from_response(version)
+            if label_regex is not None and not label_regex.search(record.label):
+                continue
+            if since is not None and record.date_created < since:
+                continue
+            if until is not None and record.date_created > until:
+                continue
+            yield record
+
+    @traced('create_application_version', 'version', 'key')
+    def create_application_version(self, version_label, key, content_hash=None):
+        """
+        Creates an application version, the archive's
+        content_hash is recorded in the version description
         """
         out("Creating application version " + str(version_label) + " for " + str(key))
-        self.ebs.create_application_version(self.app_name, version_label,
+        description = None
+        if content_hash is not None:
+            description = 'sha256:' + content_hash
+        self.ebs.create_application_version(self.app_name, version_label, description=description,
                                             s3_bucket=self.aws.bucket, s3_key=self.aws.bucket_path+key)
 
-    def delete_unused_versions(self, versions_to_keep=10):
+    @traced('find_archive_by_hash')
+    def find_archive_by_hash(self, content_hash, etag):
+        """
+        Returns the key (relative to the bucket path) of an
+        uploaded archive with the given content hash, or None.
+        Archives are stored under their content_key(), the
+        ETag and the hash in the metadata confirm it.
         """
-        Deletes unused versions
+        key_name = content_key(content_hash)
+        key = self.get_bucket().get_key(self.aws.bucket_path + key_name)
+        if key is None or key.get_metadata('hash') != content_hash \
+                or (key.etag or '').strip('"') != etag:
+            return None
+        return key_name
+
+    @traced('delete_unused_versions')
+    def delete_unused_versions(self, versions_to_keep=10, delete_source_bundles=False, workers=GC_WORKERS,
+                               rate=GC_RATE):
+        """
+        Deletes unused versions, up to workers at a time and
+        no faster than rate deletes per second (the rate backs
+        off when the api throttles us).  With delete_source_bundles
+        the archives of the deleted versions are removed from s3
+        as well.  If any delete fails this raises once the rest
+        have been tried.
         """
 
         # get versions in use
         environments = self.ebs.describe_environments(application_name=self.app_name, include_deleted=False)
         environments = environments['DescribeEnvironmentsResponse']['DescribeEnvironmentsResult']['Environments']
-        versions_in_use = []
+        versions_in_use = set()
         for env in environments:
-            versions_in_use.append(env['VersionLabel'])
-
-        # get all versions
-        versions = self.ebs.describe_application_versions(application_name=self.app_name)
-        versions = versions['DescribeApplicationVersionsResponse']['DescribeApplicationVersionsResult'][
-            'ApplicationVersions']
-        versions = sorted(versions, reverse=True, key=functools.cmp_to_key(lambda x, y: (x['DateCreated'] > y['DateCreated']) - (x['DateCreated'] < y['DateCreated'])))
-
-        # delete versions in use
-        for version in versions[versions_to_keep:]:
-            if version['VersionLabel'] in versions_in_use:
-                out("Not deleting " + version["VersionLabel"] + " because it is in use")
+            versions_in_use.add(env.get('VersionLabel'))
+
+        from boto.exception import BotoServerError
+        from concurrent.futures import ThreadPoolExecutor
+        limiter = TokenBucket(rate)
+
+        def _delete(version):
+            for attempt in range(GC_MAX_ATTEMPTS):
+                limiter.acquire()
+                try:
+                    out("Deleting unused version: " + version.label)
+                    self.ebs.delete_application_version(application_name=self.app_name,
+                                                        version_label=version.label)
+                    limiter.succeeded()
+                    return version
+                except BotoServerError as e:
+                    if not _is_throttling(e) or attempt + 1 >= GC_MAX_ATTEMPTS:
+                        raise
+                    limiter.throttled()
+                    self.api_stats.retried('beanstalk', 'DeleteApplicationVersion')
+                    out("Throttled deleting " + version.label + ", slowing down to "
+                        + str(round(limiter.rate, 2)) + " deletes per second")
+
+        # page through every version before deleting any, deletes
+        # shift the pages NextToken points into and would make
+        # the listing skip versions
+        versions = list(self.iter_versions())
+        candidates = []
+        for version in versions_beyond_newest(versions, versions_to_keep):
+            if version.label in versions_in_use:
+                out("Not deleting " + version.label + " because it is in use")
             else:
-                out("Deleting unused version: " + version["VersionLabel"])
-                self.ebs.delete_application_version(application_name=self.app_name,
-                                                    version_label=version['VersionLabel'])
-                sleep(2)
+                candidates.append(version)
+
+        deleted = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [(version, executor.submit(_delete, version)) for version in candidates]
+            for version, future in futures:
+                try:
+                    deleted.append(future.result())
+                except Exception as e:
+                    errors.append((version.label, e))
+
+        if delete_source_bundles:
+            # versions built from the same content share its key
+            deleted_labels = set(version.label for version in deleted)
+            self.delete_source_bundles(deleted, kept=[version for version in versions
+                                                      if version.label not in deleted_labels])
+
+        if errors:
+            for label, e in errors:
+                out("Unable to delete version " + str(label) + ": " + str(e))
+            raise Exception("Failed to delete " + str(len(errors)) + " of " + str(len(candidates))
+                            + " unused version(s): " + ", ".join(str(label) for label, e in errors))
+        return deleted
+
+    @traced('delete_source_bundles')
+    def delete_source_bundles(self, versions, kept=()):
+        """
+        Deletes the s3 archives of ApplicationVersions, batching
+        them into multi-object deletes.  Bundles outside of our
+        bucket, or still used by a version in kept, are left alone.
+        """
+        in_use = set((version.s3_bucket, version.s3_key) for version in kept)
+        keys = []
+        for version in versions:
+            if version.s3_bucket == self.aws.bucket and version.s3_key \
+                    and (version.s3_bucket, version.s3_key) not in in_use and version.s3_key not in keys:
+                keys.append(version.s3_key)
+        if not keys:
+            return
+        bucket = self.s3.get_bucket(self.aws.bucket, validate=False)
+        for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            batch = keys[i:i + S3_DELETE_BATCH_SIZE]
+            out("Deleting " + str(len(batch)) + " source bundle(s) from s3")
+            result = bucket.delete_keys(batch, quiet=True)
+            for error in result.errors:
+                out("Unable to delete " + str(error.key) + ": " + str(error.message))
 
     def describe_events(self, environment_name, next_token=None, start_time=None):
         """
@@ -453,11 +2613,25 @@ class EbsHelper(object):
 
         return (events['DescribeEventsResponse']['DescribeEventsResult']['Events'], events['DescribeEventsResponse']['DescribeEventsResult']['NextToken'])
 
+    def describe_application_events(self, start_time=None, next_token=None):
+        """
+        Describes events from every environment of the application,
+        start_time is an iso 8601 UTC timestamp
+        """
+        events = self.ebs.describe_events(
+            application_name=self.app_name,
+            next_token=next_token,
+            start_time=start_time)
+
+        return (events['DescribeEventsResponse']['DescribeEventsResult']['Events'],
+                events['DescribeEventsResponse']['DescribeEventsResult'].get('NextToken'))
+
     def wait_for_environments(self, environment_names, health=None, status=None, version_label=None,
-                              include_deleted=True, use_events=True):
+                              include_deleted=True, use_events=True, fail_fast=True):
         """
         Waits for an environment to have the given version_label
-        and to be in the green state
+        and to be in the green state, raising HealthCheckFailed
+        when one breaks the health rules unless fail_fast is false
         """
 
         # turn into a list
@@ -465,6 +2639,15 @@ class EbsHelper(object):
             environment_names = [environment_names]
         environment_names = environment_names[:]
 
+        with span('wait_for_environments', environments=", ".join(environment_names), health=health,
+                  status=status, version=version_label):
+            return self._wait_for_environments(environment_names, health=health, status=status,
+                                               version_label=version_label, include_deleted=include_deleted,
+                                               use_events=use_events, fail_fast=fail_fast)
+
+    def _wait_for_environments(self, environment_names, health, status, version_label, include_deleted,
+                               use_events, fail_fast):
+
         # print some stuff
         s = "Waiting for environment(s) " + (", ".join(environment_names)) + " to"
         if health is not None:
@@ -478,12 +2661,11 @@ class EbsHelper(object):
         out(s)
 
         started = time()
-        seen_events = list()
-
-        for env_name in environment_names:
-            (events, next_token) = self.describe_events(env_name, start_time=datetime.now().isoformat())
-            for event in events:
-                seen_events.append(event)
+        schedule = self.poll_schedule()
+        rules = self.health_rules() if fail_fast else None
+        events = None
+        if use_events:
+            events = EventCursor(self, environment_names)
 
         while True:
             # bail if they're all good
@@ -491,7 +2673,7 @@ class EbsHelper(object):
                 break
 
             # wait
-            sleep(10)
+            sleep(schedule.next_delay())
 
             # # get the env
             environments = self.ebs.describe_environments(
@@ -523,15 +2705,14 @@ class EbsHelper(object):
                 if version_label is not None:
                     good_to_go = good_to_go and str(env['VersionLabel']) == version_label
 
-                # allow a certain number of Red samples before failing
-                if env['Status'] == 'Ready' and env['Health'] == 'Red':
-                    if 'RedCount' not in env:
-                        env['RedCount'] = 0
-
-                    env['RedCount'] += 1
-                    if env['RedCount'] > MAX_RED_SAMPLES:
-                        out('Deploy failed')
-                        raise Exception('Ready and red')
+                # give up early on a broken environment
+                try:
+                    if rules is not None:
+                        rules.check_environment(env)
+                except HealthCheckFailed:
+                    out(msg + " ... failed")
+                    out('Deploy failed')
+                    raise
 
                 # log it
                 if good_to_go:
@@ -540,12 +2721,19 @@ class EbsHelper(object):
                 else:
                     out(msg + " ... waiting")
 
-                # log events
-                (events, next_token) = self.describe_events(env_name, start_time=datetime.now().isoformat())
-                for event in events:
-                    if event not in seen_events:
-                        out("["+event['Severity']+"] "+event['Message'])
-                        seen_events.append(event)
+            # log events
+            new_events = []
+            if events is not None:
+                new_events = events.poll()
+                for event in new_events:
+                    out("["+event['Severity']+"] "+event['Message'])
+                try:
+                    if rules is not None:
+                        rules.check_events(new_events)
+                except HealthCheckFailed:
+                    out('Deploy failed')
+                    raise
+            schedule.observe(environments, new_events)
 
             # check the time
             elapsed = time() - started
@@ -0,0 +1,174 @@
+"""
+The ebs-deploy command line, scripts/ebs-deploy runs it
+directly or hands it to a running daemon (see daemon.py)
+"""
+
+import argparse
+import sys
+import os
+from ebs_deploy import AwsCredentials, EbsHelper, MetadataCache, PollSchedule, HealthRules, DEFAULT_CACHE_FILE, \
+    DEFAULT_CACHE_TTL, clear_config_caches, get, load_config, out, span, start_trace, stop_trace
+from ebs_deploy.commands import get_command, usage
+
+
+class Session(object):
+    """
+    Creates the credentials, caches and helpers a command
+    runs with
+    """
+
+    def assume_role(self, role_arn, role_name):
+        """
+        Returns credentials for the given role
+        """
+        from boto.sts import STSConnection
+        sts_connection = STSConnection()
+        return sts_connection.assume_role(
+            role_arn=role_arn,
+            role_session_name=role_name
+        ).credentials
+
+    def metadata_cache(self, filename, ttl, refresh):
+        return MetadataCache(filename, ttl=ttl, refresh=refresh)
+
+    def helper(self, aws, app_name, wait_time_secs, cache, poll_schedule, health_rules):
+        return EbsHelper(aws, app_name=app_name, wait_time_secs=wait_time_secs, cache=cache,
+                         poll_schedule=poll_schedule, health_rules=health_rules)
+
+
+# the commands
+def main(argv=None, session=None):
+    """
+    the main, argv defaults to sys.argv
+    """
+    if argv is None:
+        argv = sys.argv
+    if session is None:
+        session = Session()
+
+    # bail if we don't have a command
+    if len(argv)<2:
+        usage()
+        exit(-1)
+
+    # get the command
+    command_name = argv[1]
+
+    # setup arguments
+    parser = argparse.ArgumentParser(description='Deploy to Amazon Beanstalk', usage='%(prog)s '+command_name+' [options]')
+    parser.add_argument('-c', '--config-file', help='Configuration file', default='ebs.config')
+    parser.add_argument('-v', '--verbose', help='Enable debug logging', action='store_true')
+    parser.add_argument('-ra', '--role-arn', help='Role ARN to switch to (ie: arn:aws:iam::111111111111:role/RoleName)', required=False)
+    parser.add_argument('-rn', '--role-name', help='Set display name for role (If using --role-arn, this is required)', required=False)
+    parser.add_argument('-wt', '--wait-time', help='timeout for command', required=False, type=int, default=300)
+    parser.add_argument('--refresh-cache', help='Ignore the cached aws metadata and load it again', action='store_true')
+    parser.add_argument('--trace', help='Write a timing trace of the command to this file', required=False)
+    parser.add_argument('--trace-format', help='Format of the trace file: chrome (chrome://tracing, ui.perfetto.dev) or json',
+                        choices=['chrome', 'json'], default='chrome')
+    parser.add_argument('--api-stats', help='Print the number of aws api calls made and their latencies when done',
+                        action='store_true')
+    command = get_command(command_name)
+
+    # let commands add arguments
+    try:
+        command.add_arguments(parser)
+    except AttributeError:
+        pass
+
+    # check for help
+    if len(argv) == 3 and argv[2]=='help':
+        parser.print_help()
+        exit(-1)
+
+    # parse arguments
+    args = parser.parse_args(argv[2:])
+
+    # commands that run without a config
+    if not getattr(command, 'REQUIRES_CONFIG', True):
+        exit(command.execute(None, None, args))
+
+    # make sure we have an archive or a directory
+    if not args.config_file or not os.path.exists(args.config_file):
+        out("Config file not found: "+args.config_file)
+        parser.print_help()
+        exit(-1)
+
+    # make sure that if we have a role to assume, that we also have a role name to display
+    if (args.role_arn and not args.role_name) or (args.role_name and not args.role_arn):
+        out("You must use and --role-arn and --role-name together")
+        parser.print_help()
+        exit(-1)
+
+    # trace the command
+    trace = start_trace() if args.trace else None
+    try:
+        with span(command_name):
+            code = run_command(command, args, session)
+    finally:
+        if trace is not None:
+            stop_trace()
+            trace.save(args.trace, format=args.trace_format)
+            out("Trace written to " + args.trace)
+    exit(code)
+
+
+def run_command(command, args, session):
+    """
+    Creates the helper for a command and runs it, returns
+    the command's exit code
+    """
+
+    # enable logging
+    if args.verbose:
+        from boto import set_stream_logger
+        set_stream_logger('boto')
+
+    # load config, forgetting what the last command parsed
+    clear_config_caches()
+    with span('load_config'):
+        config = load_config(args.config_file)
+
+    if args.role_arn: 
+        try:
+            credentials = session.assume_role(args.role_arn, args.role_name)
+        except:
+            out("Oops! something went wrong trying to assume the specified role")
+        else:
+            # create credentials for switching roles
+            aws = AwsCredentials(
+                credentials.access_key,
+                credentials.secret_key,
+                credentials.session_token,
+                get(config, 'aws.region',           os.environ.get('AWS_DEFAULT_REGION')),
+                get(config, 'aws.bucket',           os.environ.get('AWS_BEANSTALK_BUCKET_NAME')),
+                get(config, 'aws.bucket_path',      os.environ.get('AWS_BEANSTALK_BUCKET_NAME_PATH')),
+                account=args.role_arn)
+            out("Using Role: "+args.role_name)
+    else:
+        # create credentials
+        aws = AwsCredentials(
+            get(config, 'aws.access_key',       os.environ.get('AWS_ACCESS_KEY_ID')),
+            get(config, 'aws.secret_key',       os.environ.get('AWS_SECRET_ACCESS_KEY')),
+            get(config, 'aws.secret_token',     os.environ.get('AWS_SECRET_TOKEN')),
+            get(config, 'aws.region',           os.environ.get('AWS_DEFAULT_REGION')),
+            get(config, 'aws.bucket',           os.environ.get('AWS_BEANSTALK_BUCKET_NAME')),
+            get(config, 'aws.bucket_path',      os.environ.get('AWS_BEANSTALK_BUCKET_NAME_PATH')))
+
+    # metadata cache
+    cache = None
+    if get(config, 'cache.enabled', True):
+        cache = session.metadata_cache(get(config, 'cache.file', DEFAULT_CACHE_FILE),
+                                       int(get(config, 'cache.ttl', DEFAULT_CACHE_TTL)),
+                                       args.refresh_cache)
+
+    # create helper
+    helper = session.helper(aws, get(config, 'app.app_name'), args.wait_time, cache,
+                            lambda: PollSchedule.from_config(get(config, 'poll', {})),
+                            lambda: HealthRules.from_config(get(config, 'fail_fast', {})))
+
+    # execute the command
+    try:
+        return command.execute(helper, config, args)
+    finally:
+        if args.api_stats:
+            helper.api_stats.report()
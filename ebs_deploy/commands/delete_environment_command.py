@@ -1,4 +1,4 @@
-from ebs_deploy import out, parse_env_config
+from ebs_deploy import out, for_each_environment
 
 
 def add_arguments(parser):
@@ -6,10 +6,13 @@ def add_arguments(parser):
     Args for the delete environment command
     """
     parser.add_argument('-e', '--environment',
-                        help='Environment name', required=True)
+                        help='Environment name(s)', required=True, nargs='+')
     parser.add_argument('-w', '--dont-wait',
                         help='Skip waiting for the init to finish',
                         action='store_true')
+    parser.add_argument('-p', '--parallel',
+                        help='Number of environments to delete at once',
+                        type=int, default=1)
 
 
 def execute(helper, config, args):
@@ -17,23 +20,27 @@ def execute(helper, config, args):
     Deletes an environment
     """
 
-    env_config = parse_env_config(config, args.environment)
-    environments_to_wait_for_term = []
+    environments_to_delete = []
     environments = helper.get_environments()
 
     for env in environments:
-        if env['EnvironmentName'] == args.environment:
+        if env['EnvironmentName'] in args.environment:
             if env['Status'] != 'Ready':
                 out("Unable to delete " + env['EnvironmentName']
                     + " because it's not in status Ready ("
                     + env['Status'] + ")")
             else:
-                out("Deleting environment: "+env['EnvironmentName'])
-                helper.delete_environment(env['EnvironmentName'])
-                environments_to_wait_for_term.append(env['EnvironmentName'])
+                environments_to_delete.append(env['EnvironmentName'])
+
+    def _delete(env_name):
+        out("Deleting environment: " + env_name)
+        helper.delete_environment(env_name)
+
+    for_each_environment(environments_to_delete, _delete,
+                         parallel=args.parallel)
 
     if not args.dont_wait:
-        helper.wait_for_environments(environments_to_wait_for_term,
+        helper.wait_for_environments(environments_to_delete,
                                      status='Terminated',
                                      include_deleted=True)
 
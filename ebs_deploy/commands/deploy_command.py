@@ -1,4 +1,5 @@
-from ebs_deploy import get, parse_env_config, parse_option_settings, upload_application_archive
+from ebs_deploy import get, parse_env_config, parse_option_settings, upload_application_archive, \
+    collect_unused_versions, rollback_versions, HealthCheckFailed
 
 
 def add_arguments(parser):
@@ -10,6 +11,8 @@ def add_arguments(parser):
     parser.add_argument('-a', '--archive', help='Archive file', required=False)
     parser.add_argument('-d', '--directory', help='Directory', required=False)
     parser.add_argument('-l', '--version-label', help='Version label', required=False)
+    parser.add_argument('-aw', '--archive-workers', help='Number of threads used to compress the archive',
+                        type=int, required=False)
     parser.add_argument('-f', '--log-events-to-file', help='Log events to file',
                         required=False, action='store_true')
 
@@ -25,34 +28,42 @@ def execute(helper, config, args):
     # upload or build an archive
     version_label = upload_application_archive(
         helper, env_config, archive=args.archive,
-        directory=args.directory, version_label=version_label)
+        directory=args.directory, version_label=version_label,
+        archive_workers=args.archive_workers)
 
     import datetime
     start_time = datetime.datetime.utcnow().isoformat() + 'Z'
-    # deploy it
-    helper.deploy_version(env_name, version_label)
+    previous = None
+    if get(config, 'fail_fast.rollback', False):
+        previous = helper.environment_snapshot().by_name.get(env_name, {}).get('VersionLabel')
+    try:
+        # deploy it
+        helper.deploy_version(env_name, version_label)
 
-    # wait
-    if not args.dont_wait:
-        helper.wait_for_environments(env_name, status='Ready',
-                                     version_label=version_label,
-                                     include_deleted=False)
+        # wait
+        if not args.dont_wait:
+            helper.wait_for_environments(env_name, status='Ready',
+                                         version_label=version_label,
+                                         include_deleted=False)
 
-    # update it
-    env = parse_env_config(config, env_name)
-    option_settings = parse_option_settings(env.get('option_settings', {}))
-    helper.update_environment(env_name,
-                              description=env.get('description', None),
-                              option_settings=option_settings,
-                              tier_type=env.get('tier_type'),
-                              tier_name=env.get('tier_name'),
-                              tier_version=env.get('tier_version'))
+        # update it
+        env = parse_env_config(config, env_name)
+        option_settings = parse_option_settings(env.get('option_settings', {}))
+        helper.update_environment(env_name,
+                                  description=env.get('description', None),
+                                  option_settings=option_settings,
+                                  tier_type=env.get('tier_type'),
+                                  tier_name=env.get('tier_name'),
+                                  tier_version=env.get('tier_version'))
 
-    # wait
-    if not args.dont_wait:
-        helper.wait_for_environments(env_name, health='Green',
-                                     status='Ready', version_label=version_label,
-                                     include_deleted=False)
+        # wait
+        if not args.dont_wait:
+            helper.wait_for_environments(env_name, health='Green',
+                                         status='Ready', version_label=version_label,
+                                         include_deleted=False)
+    except HealthCheckFailed:
+        rollback_versions(helper, config, {env_name: previous})
+        raise
 
     events = helper.ebs.describe_events(start_time=start_time, environment_name=env_name)
     import json
@@ -61,4 +72,4 @@ def execute(helper, config, args):
             json.dump(events, f)
 
     # delete unused
-    helper.delete_unused_versions(versions_to_keep=int(get(config, 'app.versions_to_keep', 10)))
+    collect_unused_versions(helper, config, deploying=True)
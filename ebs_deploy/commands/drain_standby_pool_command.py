@@ -0,0 +1,37 @@
+from ebs_deploy import out, get, for_each_environment
+
+
+def add_arguments(parser):
+    """
+    Args for the drain_standby_pool command
+    """
+    parser.add_argument('-e', '--environment', help='Environment name(s), defaults to every environment',
+                        nargs='+', required=False)
+    parser.add_argument('-w', '--dont-wait', help='Skip waiting for the standby environments to terminate',
+                        action='store_true')
+    parser.add_argument('-p', '--parallel', help='Number of environments to delete at once', type=int, default=1)
+
+
+def execute(helper, config, args):
+    """
+    Terminates standby environments
+    """
+    environments_to_delete = []
+    for env_name in args.environment or list(get(config, 'app.environments').keys()):
+        for env in helper.standby_environments(env_name):
+            if env['Status'] != 'Ready':
+                out("Unable to delete " + env['EnvironmentName'] + " because it's not in status Ready ("
+                    + env['Status'] + ")")
+            else:
+                environments_to_delete.append(env['EnvironmentName'])
+
+    def _delete(env_name):
+        out("Deleting standby environment: " + env_name)
+        helper.delete_environment(env_name)
+
+    for_each_environment(environments_to_delete, _delete, parallel=args.parallel)
+
+    if not args.dont_wait and environments_to_delete:
+        helper.wait_for_environments(environments_to_delete, status='Terminated', include_deleted=True)
+    out("Standby pool drained")
+    return 0
@@ -0,0 +1,41 @@
+from ebs_deploy import out, get, parse_env_config, for_each_environment, fill_standby_pool
+
+
+def add_arguments(parser):
+    """
+    Args for the fill_standby_pool command
+    """
+    parser.add_argument('-e', '--environment', help='Environment name(s), defaults to every environment with a '
+                        'standby.size', nargs='+', required=False)
+    parser.add_argument('-s', '--size', help='Number of standby environments to keep, overrides standby.size',
+                        type=int, required=False)
+    parser.add_argument('-w', '--dont-wait', help='Skip waiting for the standby environments', action='store_true')
+    parser.add_argument('-p', '--parallel', help='Number of environments to work on at once', type=int, default=1)
+
+
+def execute(helper, config, args):
+    """
+    Creates standby environments for zdt_deploy
+    """
+    environment_names = args.environment
+    if not environment_names:
+        environment_names = [env_name for env_name in get(config, 'app.environments').keys()
+                             if int(get(parse_env_config(config, env_name), 'standby.size', 0)) > 0]
+    if not environment_names:
+        out("No environments have a standby.size")
+        return 0
+
+    def _fill(env_name):
+        created = fill_standby_pool(helper, parse_env_config(config, env_name), env_name, size=args.size)
+        if not created:
+            out("Standby pool is full")
+        return created
+
+    created = for_each_environment(environment_names, _fill, parallel=args.parallel)
+    environments_to_wait_for = [standby for env_name in environment_names for standby in created[env_name]]
+
+    if not args.dont_wait and environments_to_wait_for:
+        helper.wait_for_environments(environments_to_wait_for, status='Ready', health='Green',
+                                     include_deleted=False)
+    out("Standby pool filled")
+    return 0
@@ -0,0 +1,28 @@
+from ebs_deploy import get, GC_RATE, GC_WORKERS
+
+
+def add_arguments(parser):
+    """
+    adds arguments for the gc versions command
+    """
+    parser.add_argument('-k', '--versions-to-keep', help='Number of unused versions to keep',
+                        type=int, required=False)
+    parser.add_argument('-b', '--delete-source-bundles', help='Delete the s3 archives of deleted versions',
+                        action='store_true')
+    parser.add_argument('-p', '--parallel', help='Number of versions to delete at once', type=int, required=False)
+    parser.add_argument('-r', '--rate', help='Maximum number of deletes per second', type=float, required=False)
+
+
+def execute(helper, config, args):
+    """
+    Deletes unused application versions
+    """
+    versions_to_keep = args.versions_to_keep
+    if versions_to_keep is None:
+        versions_to_keep = int(get(config, 'app.versions_to_keep', 10))
+    helper.delete_unused_versions(
+        versions_to_keep=versions_to_keep,
+        delete_source_bundles=args.delete_source_bundles or get(config, 'app.gc.delete_source_bundles', False),
+        workers=args.parallel or int(get(config, 'app.gc.workers', GC_WORKERS)),
+        rate=args.rate or float(get(config, 'app.gc.rate', GC_RATE)))
+    return 0
@@ -1,5 +1,6 @@
 
-from ebs_deploy import out, get, parse_env_config, parse_option_settings, upload_application_archive
+from ebs_deploy import out, get, parse_env_config, parse_option_settings, upload_application_archive, \
+    for_each_environment, STANDBY_DESCRIPTION
 
 def add_arguments(parser):
     """
@@ -8,6 +9,7 @@ def add_arguments(parser):
     parser.add_argument('-w', '--dont-wait', help='Skip waiting for the init to finish', action='store_true')
     parser.add_argument('-d', '--delete', help='Delete unknown environments', action='store_true')
     parser.add_argument('-l', '--version-label', help='The name of the application version to deploy', default=None)
+    parser.add_argument('-p', '--parallel', help='Number of environments to work on at once', type=int, default=1)
 
 def execute(helper, config, args):
     """
@@ -21,10 +23,9 @@ def execute(helper, config, args):
         out("Application "+get(config, 'app.app_name')+" exists")
 
     # create environments
-    environment_names = []
-    environments_to_wait_for_green = []
-    for env_name, env_config in list(get(config, 'app.environments').items()):
-        environment_names.append(env_name)
+    environment_names = list(get(config, 'app.environments').keys())
+
+    def _create(env_name):
         env_config = parse_env_config(config, env_name)
         if not helper.environment_exists(env_name):
             option_settings = parse_option_settings(env_config.get('option_settings', {}))
@@ -37,22 +38,34 @@ def execute(helper, config, args):
                 tier_type=env_config.get('tier_type'),
                 tier_version=env_config.get('tier_version'),
                 version_label=args.version_label)
-            environments_to_wait_for_green.append(env_name)
+            return True
         else:
             out("Environment "+env_name)
+            return False
+
+    created = for_each_environment(environment_names, _create, parallel=args.parallel)
+    environments_to_wait_for_green = [env_name for env_name in environment_names if created[env_name]]
 
     # get the environments
     environments_to_wait_for_term = []
     if args.delete:
+        environments_to_delete = []
         environments = helper.get_environments()
         for env in environments:
             if env['EnvironmentName'] not in environment_names:
-                if env['Status'] != 'Ready':
+                if (env.get('Description') or '').startswith(STANDBY_DESCRIPTION):
+                    out("Keeping standby environment "+env['EnvironmentName'])
+                elif env['Status'] != 'Ready':
                     out("Unable to delete "+env['EnvironmentName']+" because it's not in status Ready ("+env['Status']+")")
                 else:
-                    out("Deleting environment: "+env['EnvironmentName'])
-                    helper.delete_environment(env['EnvironmentName'])
-                    environments_to_wait_for_term.append(env['EnvironmentName'])
+                    environments_to_delete.append(env['EnvironmentName'])
+
+        def _delete(env_name):
+            out("Deleting environment: "+env_name)
+            helper.delete_environment(env_name)
+
+        for_each_environment(environments_to_delete, _delete, parallel=args.parallel)
+        environments_to_wait_for_term = environments_to_delete
 
     # wait
     if not args.dont_wait and len(environments_to_wait_for_green)>0:
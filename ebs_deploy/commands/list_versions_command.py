@@ -1,11 +1,38 @@
-from ebs_deploy import out
+from datetime import datetime
+from ebs_deploy import out, newest_versions, parse_timestamp
+
+
+def add_arguments(parser):
+    """
+    adds arguments for the list versions command
+    """
+    parser.add_argument('-l', '--label', help='Only list versions whose label matches this regex', required=False)
+    parser.add_argument('-s', '--since', help='Only list versions created on or after this date (YYYY-MM-DD)',
+                        required=False)
+    parser.add_argument('-u', '--until', help='Only list versions created on or before this date (YYYY-MM-DD)',
+                        required=False)
+    parser.add_argument('-n', '--newest', help='Only list the newest N versions', type=int, required=False)
 
 
 def execute(helper, config, args):
     """
-    Lists environments
+    Lists versions
     """
-    versions = helper.get_versions()
+    until = None
+    if args.until:
+        until = parse_timestamp(args.until)
+        if len(args.until) == len('YYYY-MM-DD'):
+            until += 24 * 60 * 60 - 0.001
+
+    versions = helper.iter_versions(
+        label=args.label,
+        since=parse_timestamp(args.since) if args.since else None,
+        until=until)
+    if args.newest is not None:
+        versions = newest_versions(versions, args.newest)
+
     out("Deployed versions:")
     for version in versions:
-        out(version)
+        out(version.label + "\t" + datetime.utcfromtimestamp(version.date_created).strftime('%Y-%m-%d %H:%M:%S')
+            + "\t" + str(version.s3_bucket) + "/" + str(version.s3_key)
+            + ("\t" + version.description if version.description else ""))
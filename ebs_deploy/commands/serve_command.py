@@ -0,0 +1,20 @@
+
+from ebs_deploy.daemon import serve
+
+# the daemon doesn't need a config file
+REQUIRES_CONFIG = False
+
+
+def add_arguments(parser):
+    """
+    adds arguments for the serve command
+    """
+    parser.add_argument('-s', '--socket', help='Socket to listen on (default: $EBS_DEPLOY_SOCKET or ~/.ebs-deploy/daemon.sock)', required=False)
+
+
+def execute(helper, config, args):
+    """
+    Runs the ebs-deploy daemon, other ebs-deploy commands are
+    sent to it while it's running
+    """
+    return serve(args.socket)
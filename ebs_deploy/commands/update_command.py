@@ -1,5 +1,5 @@
 
-from ebs_deploy import out, get, parse_env_config, parse_option_settings
+from ebs_deploy import out, parse_env_config, parse_option_settings, collect_unused_versions
 
 def add_arguments(parser):
     """
@@ -38,4 +38,4 @@ def execute(helper, config, args):
         helper.wait_for_environments(env_name, health='Green', status='Ready', version_label=args.version_label)
 
     # delete unused
-    helper.delete_unused_versions(versions_to_keep=int( get(config, 'app.versions_to_keep', 10) ))
\ No newline at end of file
+    collect_unused_versions(helper, config, deploying=True)
\ No newline at end of file
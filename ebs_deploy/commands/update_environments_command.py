@@ -1,5 +1,5 @@
 
-from ebs_deploy import out, get, parse_env_config, parse_option_settings
+from ebs_deploy import out, get, parse_env_config, parse_option_settings, for_each_environment
 
 def add_arguments(parser):
     """
@@ -7,6 +7,7 @@ def add_arguments(parser):
     """
     parser.add_argument('-e', '--environment',  help='Environment name', required=False, nargs='+')
     parser.add_argument('-w', '--dont-wait', help='Skip waiting for the app to be deleted', action='store_true')
+    parser.add_argument('-p', '--parallel', help='Number of environments to update at once', type=int, default=1)
 
 def execute(helper, config, args):
     """
@@ -20,8 +21,7 @@ def execute(helper, config, args):
         for env_name, env_config in list(get(config, 'app.environments').items()):
             environments.append(env_name)
 
-    wait_environments = []
-    for env_name in environments:
+    def _update(env_name):
         env = parse_env_config(config, env_name)
         option_settings = parse_option_settings(env.get('option_settings', {}))
         helper.update_environment(env_name,
@@ -30,7 +30,9 @@ def execute(helper, config, args):
             tier_type=env.get('tier_type'),
             tier_name=env.get('tier_name'),
             tier_version=env.get('tier_version'))
-        wait_environments.append(env_name)
+
+    for_each_environment(environments, _update, parallel=args.parallel)
+    wait_environments = environments
 
     # wait
     if not args.dont_wait:
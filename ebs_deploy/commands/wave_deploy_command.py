@@ -0,0 +1,79 @@
+from ebs_deploy import out, get, parse_env_config, parse_option_settings, upload_application_archive, \
+    collect_unused_versions, for_each_environment, span, rollback_versions, HealthCheckFailed
+
+
+def add_arguments(parser):
+    """
+    adds arguments for the wave_deploy command
+    """
+    parser.add_argument('-e', '--environment', help='Environment names, in the order to deploy them, defaults to '
+                        'every environment', nargs='+', required=False)
+    parser.add_argument('-s', '--wave-size', help='Number of environments deployed to at once, overrides '
+                        'app.wave_size', type=int, required=False)
+    parser.add_argument('-a', '--archive', help='Archive file', required=False)
+    parser.add_argument('-d', '--directory', help='Directory', required=False)
+    parser.add_argument('-l', '--version-label', help='Version label', required=False)
+    parser.add_argument('-aw', '--archive-workers', help='Number of threads used to compress the archive',
+                        type=int, required=False)
+
+
+def execute(helper, config, args):
+    """
+    Deploys one version to many environments, a wave of them
+    at a time
+    """
+    environment_names = args.environment or list(get(config, 'app.environments').keys())
+    wave_size = args.wave_size or int(get(config, 'app.wave_size', 1))
+    if wave_size < 1:
+        raise Exception("The wave size must be at least 1")
+
+    # one archive for all of them, so they have to agree on it
+    env_configs = dict((env_name, parse_env_config(config, env_name)) for env_name in environment_names)
+    archive_config = env_configs[environment_names[0]].get('archive')
+    for env_name in environment_names[1:]:
+        if env_configs[env_name].get('archive') != archive_config:
+            raise Exception("Environments " + environment_names[0] + " and " + env_name
+                            + " build different archives, deploy them separately")
+
+    # upload or build an archive
+    version_label = upload_application_archive(
+        helper, env_configs[environment_names[0]], archive=args.archive, directory=args.directory,
+        version_label=args.version_label, archive_workers=args.archive_workers)
+
+    def _update(env_name):
+        env = env_configs[env_name]
+        helper.update_environment(env_name,
+                                  description=env.get('description', None),
+                                  option_settings=parse_option_settings(env.get('option_settings', {})),
+                                  tier_type=env.get('tier_type'),
+                                  tier_name=env.get('tier_name'),
+                                  tier_version=env.get('tier_version'))
+
+    waves = [environment_names[i:i + wave_size] for i in range(0, len(environment_names), wave_size)]
+    for number, wave in enumerate(waves, 1):
+        out("Wave " + str(number) + " of " + str(len(waves)) + ": " + ", ".join(wave))
+        with span('wave', number=number, environments=", ".join(wave)):
+            # the wave's environments are waited for together,
+            # a failure stops the waves that follow
+            previous = {}
+            if get(config, 'fail_fast.rollback', False):
+                snapshot = helper.environment_snapshot()
+                previous = dict((env_name, snapshot.by_name.get(env_name, {}).get('VersionLabel'))
+                                for env_name in wave)
+            try:
+                for_each_environment(wave, lambda env_name: helper.deploy_version(env_name, version_label),
+                                     parallel=len(wave))
+                helper.wait_for_environments(wave, status='Ready', version_label=version_label,
+                                             include_deleted=False)
+                for_each_environment(wave, _update, parallel=len(wave))
+                helper.wait_for_environments(wave, health='Green', status='Ready', version_label=version_label,
+                                             include_deleted=False)
+            except HealthCheckFailed:
+                # earlier waves were healthy and are left alone
+                rollback_versions(helper, config, previous)
+                raise
+
+    out("Deployed " + version_label + " to " + str(len(environment_names)) + " environment(s)")
+
+    # delete unused
+    collect_unused_versions(helper, config, deploying=True)
@@ -1,5 +1,8 @@
+import threading
 import time
-from ebs_deploy import out, get, parse_env_config, parse_option_settings, upload_application_archive
+from ebs_deploy import out, get, parse_env_config, parse_option_settings, upload_application_archive, \
+    collect_unused_versions, span, run_stages, Stage, free_environment_name, free_cname_prefix, ready_standby, \
+    claim_standby, fill_standby_pool, HealthCheckFailed
 
 
 def add_arguments(parser):
@@ -11,6 +14,10 @@ def add_arguments(parser):
     parser.add_argument('-a', '--archive', help='Archive file', required=False)
     parser.add_argument('-d', '--directory', help='Directory', required=False)
     parser.add_argument('-l', '--version-label', help='Version label', required=False)
+    parser.add_argument('-aw', '--archive-workers', help='Number of threads used to compress the archive',
+                        type=int, required=False)
+    parser.add_argument('-ns', '--no-standby', help="Don't use or refill the standby environment pool",
+                        action='store_true')
     parser.add_argument('-t', '--termination-delay',
                         help='Delay termination of old environment by this number of seconds',
                         type=int, required=False)
@@ -21,7 +28,6 @@ def execute(helper, config, args):
     Deploys to an environment
     """
     version_label = args.version_label
-    archive = args.archive
 
     # get the environment configuration
     env_config = parse_env_config(config, args.environment)
@@ -34,67 +40,132 @@ def execute(helper, config, args):
         raise Exception(
             "Only able to do zero downtime deployments for "
             "WebServer tiers, can't do them for %s" % (tier_name, ))
+    use_standby = not args.no_standby and int(get(env_config, 'standby.size', 0)) > 0
+
+    discovered = threading.Event()
+    discovery = []
+
+    def discover(results):
+        try:
+            discovery.append(_discover())
+            return discovery[0]
+        finally:
+            discovered.set()
+
+    def discovery_succeeded():
+        # the archive is built while the environments are looked
+        # up, its application version waits for them to be found
+        discovered.wait()
+        if not discovery:
+            raise Exception("Not creating application version, the environments couldn't be looked up")
+
+    def _discover():
+        # find existing environment name, the environment
+        # lookups below all come from one environment snapshot
+        old_env_name = helper.environment_name_for_cname(cname_prefix)
+        if old_env_name is None:
+            raise Exception("Unable to find current environment with cname: " + cname_prefix)
+        out("Current environment name is " + old_env_name)
+
+        # use a standby if there's one ready
+        if use_standby:
+            standby_name = ready_standby(helper, args.environment,
+                                         solution_stack_name=env_config.get('solution_stack_name'))
+            if standby_name is not None:
+                out("Deploying to standby environment " + standby_name)
+                return standby_name, None, old_env_name
+            out("No standby environment is ready")
+
+        # find an available environment name
+        out("Determining new environment name...")
+        if not helper.environment_exists(args.environment):
+            new_env_name = args.environment
+        else:
+            new_env_name = free_environment_name(helper, args.environment)
+        if new_env_name is None:
+            raise Exception("Unable to determine new environment name")
+        out("New environment name will be " + new_env_name)
+
+        # find an available cname name
+        out("Determining new environment cname...")
+        new_env_cname = free_cname_prefix(helper, cname_prefix)
+        if new_env_cname is None:
+            raise Exception("Unable to determine new environment cname")
+        out("New environment cname will be " + new_env_cname)
+        return new_env_name, new_env_cname, old_env_name
+
+    def archive(results):
+        # upload or build an archive
+        return upload_application_archive(
+            helper, env_config, archive=args.archive, directory=args.directory, version_label=version_label,
+            archive_workers=args.archive_workers, before_create=discovery_succeeded)
+
+    def create(results):
+        new_env_name, new_env_cname, old_env_name = results['zdt.discover']
+        try:
+            _create(new_env_name, new_env_cname, results['zdt.archive'])
+        except HealthCheckFailed:
+            # the old environment is still live, drop the new one
+            if get(config, 'fail_fast.rollback', False):
+                helper.wait_for_environments(new_env_name, status='Ready', include_deleted=False, fail_fast=False)
+                out("Deleting failed environment " + new_env_name)
+                helper.delete_environment(new_env_name)
+            raise
+
+    def _create(new_env_name, new_env_cname, version_label):
+        # create the new environment, or claim the standby
+        if new_env_cname is None:
+            claim_standby(helper, env_config, args.environment, new_env_name, version_label)
+            helper.wait_for_environments(new_env_name, status='Ready', health='Green', version_label=version_label,
+                                         include_deleted=False)
+            return
+        helper.create_environment(new_env_name,
+                                  solution_stack_name=env_config.get('solution_stack_name'),
+                                  cname_prefix=new_env_cname,
+                                  description=env_config.get('description', None),
+                                  option_settings=option_settings,
+                                  version_label=version_label,
+                                  tier_name=tier_name,
+                                  tier_type=env_config.get('tier_type'),
+                                  tier_version=env_config.get('tier_version'))
+        helper.wait_for_environments(new_env_name, status='Ready', health='Green', include_deleted=False)
+
+    def swap(results):
+        # swap C-Names
+        new_env_name, new_env_cname, old_env_name = results['zdt.discover']
+        out("Swapping environment cnames")
+        helper.swap_environment_cnames(old_env_name, new_env_name)
+        helper.wait_for_environments([old_env_name, new_env_name], status='Ready', include_deleted=False)
+
+    def terminate(results):
+        # delete the old environment
+        new_env_name, new_env_cname, old_env_name = results['zdt.discover']
+        if args.termination_delay:
+            out("Termination delay specified, sleeping for {} seconds...".format(args.termination_delay))
+            with span('termination_delay', seconds=args.termination_delay):
+                time.sleep(args.termination_delay)
+        out("Deleting old environment {}".format(old_env_name))
+        helper.delete_environment(old_env_name)
+
+    def refill(results):
+        # replace the claimed standby, it's not waited for
+        created = fill_standby_pool(helper, env_config, args.environment)
+        if created:
+            out("Creating standby environment(s) " + ", ".join(created))
 
-    # find an available environment name
-    out("Determining new environment name...")
-    new_env_name = None
-    if not helper.environment_exists(args.environment):
-        new_env_name = args.environment
-    else:
-        for i in range(10):
-            temp_env_name = args.environment + '-' + str(i)
-            if not helper.environment_exists(temp_env_name):
-                new_env_name = temp_env_name
-                break
-    if new_env_name is None:
-        raise Exception("Unable to determine new environment name")
-    out("New environment name will be " + new_env_name)
-
-    # find an available cname name
-    out("Determining new environment cname...")
-    new_env_cname = None
-    for i in range(10):
-        temp_cname = cname_prefix + '-' + str(i)
-        if not helper.environment_name_for_cname(temp_cname):
-            new_env_cname = temp_cname
-            break
-    if new_env_cname is None:
-        raise Exception("Unable to determine new environment cname")
-    out("New environment cname will be " + new_env_cname)
-
-    # upload or build an archive
-    version_label = upload_application_archive(
-        helper, env_config, archive=args.archive, directory=args.directory, version_label=version_label)
-
-    # create the new environment
-    helper.create_environment(new_env_name,
-                              solution_stack_name=env_config.get('solution_stack_name'),
-                              cname_prefix=new_env_cname,
-                              description=env_config.get('description', None),
-                              option_settings=option_settings,
-                              version_label=version_label,
-                              tier_name=tier_name,
-                              tier_type=env_config.get('tier_type'),
-                              tier_version=env_config.get('tier_version'))
-    helper.wait_for_environments(new_env_name, status='Ready', health='Green', include_deleted=False)
-
-    # find existing environment name
-    old_env_name = helper.environment_name_for_cname(cname_prefix)
-    if old_env_name is None:
-        raise Exception("Unable to find current environment with cname: " + cname_prefix)
-    out("Current environment name is " + old_env_name)
-
-    # swap C-Names
-    out("Swapping environment cnames")
-    helper.swap_environment_cnames(old_env_name, new_env_name)
-    helper.wait_for_environments([old_env_name, new_env_name], status='Ready', include_deleted=False)
-
-    # delete the old environment
-    if args.termination_delay:
-        out("Termination delay specified, sleeping for {} seconds...".format(args.termination_delay))
-        time.sleep(args.termination_delay)
-    out("Deleting old environment {}".format(old_env_name))
-    helper.delete_environment(old_env_name)
+    # the archive doesn't depend on which environments exist,
+    # so it's built and uploaded while they're looked up (but
+    # the application version isn't created unless they are)
+    stages = [
+        Stage('zdt.discover', discover),
+        Stage('zdt.archive', archive),
+        Stage('zdt.create', create, requires=['zdt.discover', 'zdt.archive']),
+        Stage('zdt.swap', swap, requires=['zdt.create']),
+        Stage('zdt.terminate', terminate, requires=['zdt.swap'])
+    ]
+    if use_standby:
+        stages.append(Stage('zdt.standby', refill, requires=['zdt.swap']))
+    run_stages(stages)
 
     # delete unused
-    helper.delete_unused_versions(versions_to_keep=int(get(config, 'app.versions_to_keep', 10)))
+    collect_unused_versions(helper, config, deploying=True)
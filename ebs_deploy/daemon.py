@@ -0,0 +1,219 @@
+"""
+Keeps an ebs-deploy process running in the background so
+commands don't pay for imports every time.  The ebs-deploy
+script sends its arguments, working directory and
+environment over a unix socket as a marshalled dict and
+prints the ('out', text), ('err', text) messages that come
+back until it gets ('exit', code).  It doesn't import
+ebs_deploy to do so, if there is no daemon it runs the
+command itself.  Each command runs in a process forked
+from the daemon that lives as long as the client does.
+"""
+
+import marshal
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from ebs_deploy import out
+
+DEFAULT_SOCKET = '~/.ebs-deploy/daemon.sock'
+
+
+def socket_path(path=None):
+    """
+    Returns the daemon's socket path, EBS_DEPLOY_SOCKET
+    overrides the default (scripts/ebs-deploy has its own
+    copy of this so the client stays light)
+    """
+    return os.path.expanduser(path or os.environ.get('EBS_DEPLOY_SOCKET') or DEFAULT_SOCKET)
+
+
+class _ClientStream(object):
+    """
+    File like object that sends everything written to it
+    to the client as (name, text) messages
+    """
+
+    def __init__(self, connection, name, lock):
+        self.connection = connection
+        self.name = name
+        self.lock = lock
+
+    def write(self, text):
+        if not text:
+            return
+        with self.lock:
+            try:
+                self.connection.sendall(marshal.dumps((self.name, text)))
+            except socket.error:
+                # the client is gone, and so is the command
+                os._exit(1)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _exit_with_client(connection):
+    """
+    Ends the process when the client hangs up (the client
+    sends nothing after its request), so killing a client
+    kills its command like it would when run locally
+    """
+    def _watch():
+        try:
+            while connection.recv(1024):
+                pass
+        except socket.error:
+            pass
+        os._exit(1)
+    watcher = threading.Thread(target=_watch, name='client-watcher')
+    watcher.daemon = True
+    watcher.start()
+
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    sys.stderr.write(str(e.code) + "\n")
+    return 1
+
+
+def handle(connection):
+    """
+    Runs one command for a client in a forked process, the
+    command sees the client's working directory, environment
+    and output
+    """
+    from ebs_deploy.cli import main
+
+    try:
+        request = marshal.load(connection.makefile('rb'))
+    except (EOFError, ValueError, TypeError):
+        # probes from serve() and clients that went away
+        return
+    _exit_with_client(connection)
+    lock = threading.Lock()
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    sys.stdout = _ClientStream(connection, 'out', lock)
+    sys.stderr = _ClientStream(connection, 'err', lock)
+    try:
+        main(request['argv'])
+        code = 0
+    except SystemExit as e:
+        code = _exit_code(e)
+    except Exception:
+        sys.stderr.write(traceback.format_exc())
+        code = 1
+    with lock:
+        try:
+            connection.sendall(marshal.dumps(('exit', code)))
+        except socket.error:
+            pass
+
+
+def _reap_children(signum, frame):
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except OSError:
+        pass
+
+
+def _warm_up():
+    """
+    Imports every command and what they use up front so the
+    forked processes don't have to
+    """
+    from ebs_deploy.commands import get_command_names, get_command_without_error_checking
+    for module in ('ebs_deploy.cli', 'boto.beanstalk', 'boto.exception', 'boto.s3.connection', 'boto.sts'):
+        __import__(module)
+    for name in get_command_names():
+        try:
+            get_command_without_error_checking(name)
+        except Exception:
+            out("Unable to load command " + name + ": " + traceback.format_exc())
+
+
+def serve(path=None):
+    """
+    Listens on the socket until interrupted, every command
+    runs in its own forked process so they can run at the
+    same time.  Only the owner can connect.
+    """
+    path = socket_path(path)
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.unlink(path)
+        else:
+            out("ebs-deploy daemon already running on " + path)
+            return -1
+        finally:
+            probe.close()
+
+    _warm_up()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    out("ebs-deploy daemon listening on " + path)
+
+    # clean up the socket when killed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGCHLD, _reap_children)
+
+    try:
+        while True:
+            connection, _ = server.accept()
+            try:
+                pid = os.fork()
+            except OSError:
+                out("Unable to fork for a request: " + traceback.format_exc())
+                connection.close()
+                continue
+            if pid:
+                connection.close()
+                continue
+
+            # the child runs the command and exits
+            code = 0
+            try:
+                server.close()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                handle(connection)
+            except BaseException:
+                code = 1
+                try:
+                    out("Error handling request: " + traceback.format_exc())
+                except BaseException:
+                    pass
+            finally:
+                os._exit(code)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+    return 0
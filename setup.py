@@ -19,7 +19,9 @@ setup(
         'ebs_deploy.commands'
     ],
 
-    # dependencies
+    # dependencies, archives are built with zipfile
+    # internals only known to work on 3.8 and later
+    python_requires='>=3.8',
     install_requires=[
         'boto>=2.45.0',
         'pyyaml>=3.10'
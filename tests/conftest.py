@@ -0,0 +1,33 @@
+"""
+The tests run against the simulator (benchmarks/simulator.py)
+instead of aws
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from ebs_deploy import AwsCredentials, EbsHelper  # noqa: E402
+from simulator import Simulator  # noqa: E402
+
+APP_NAME = 'Test'
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def simulator():
+    simulator = Simulator(launch_time=0, update_time=0, swap_time=0, terminate_time=0)
+    simulator.add_bucket(BUCKET, 'us-west-2')
+    simulator.add_application(APP_NAME)
+    return simulator
+
+
+@pytest.fixture
+def helper(simulator):
+    aws = AwsCredentials('test', 'test', None, 'us-west-2', BUCKET, 'test')
+    return EbsHelper(aws, 60, app_name=APP_NAME, connections=simulator)
@@ -0,0 +1,102 @@
+import os
+import re
+
+import pytest
+
+from ebs_deploy import ArchiveMatcher, create_archive
+
+CONFIG = [{'.ebextensions/app.config': {'yaml': {'option_settings': [{'option_name': 'A', 'value': 'b'}]}}},
+          {'VERSION': {'content': 'test'}}]
+
+
+def write_tree(directory, files):
+    for name, data in files.items():
+        path = os.path.join(directory, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (1500000000, 1500000000))
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def project(tmpdir):
+    source = str(tmpdir.mkdir('src'))
+    files = {}
+    for i in range(40):
+        # a mix of compressible and incompressible files
+        data = os.urandom(4096) if i % 3 == 0 else (b'line %d\n' % i) * 500
+        files[os.path.join('dir' + str(i % 4), 'file' + str(i) + '.txt')] = data
+    files['VERSION'] = b'replaced by the config file'
+    write_tree(source, files)
+    return source, str(tmpdir.mkdir('out'))
+
+
+def test_parallel_archive_matches_serial(project):
+    source, out_dir = project
+    serial = create_archive(source, os.path.join(out_dir, 'serial.zip'), config=CONFIG)
+    parallel = create_archive(source, os.path.join(out_dir, 'parallel.zip'), config=CONFIG, workers=4)
+    assert read(serial) == read(parallel)
+
+
+def test_incremental_archive_matches_serial(project):
+    source, out_dir = project
+    create_archive(source, os.path.join(out_dir, 'first.zip'), config=CONFIG, workers=4, incremental=True)
+
+    # change, add and remove a file, the rest are copied from first.zip
+    write_tree(source, {os.path.join('dir1', 'file1.txt'): b'changed', 'new.txt': b'new'})
+    os.remove(os.path.join(source, 'dir2', 'file2.txt'))
+
+    incremental = create_archive(source, os.path.join(out_dir, 'second.zip'), config=CONFIG, workers=4,
+                                 incremental=True)
+    serial = create_archive(source, os.path.join(out_dir, 'serial.zip'), config=CONFIG)
+    assert read(incremental) == read(serial)
+
+
+PATHS = [
+    'app.py', 'app.pyc', 'build/lib/app.py', 'build/keep', 'builder/app.py', 'docs', 'docs/index.rst',
+    'logs/x.log', 'logs/y.log', 'node_modules/a/index.js', 'src/cache/a', 'src/cache', 'src/cached/a',
+    'tmp/a', 'keeptmp/a', 'static/app.min.js', 'static/app.js'
+]
+EXCLUDES = [
+    r'build/.*', r'.*\.pyc$', r'docs$', r'(?!keep).*tmp/.*', r'src/cache\b.*', r'logs/(?=x).*',
+    r'node_modules/', r'.*\.min\.js'
+]
+
+
+@pytest.mark.parametrize('includes', [[], [r'.*\.py$', r'src/.*', r'static/.*']])
+def test_prune_dir_only_prunes_excluded_files(includes):
+    matcher = ArchiveMatcher(includes, EXCLUDES)
+    pruned = set()
+    for path in PATHS:
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            directory = '/'.join(parts[:i])
+            if matcher.prune_dir(directory):
+                pruned.add(directory)
+                assert not matcher(path), path + " is archived but " + directory + " is pruned"
+    assert {'build', 'node_modules'} <= pruned
+    assert not pruned & {'logs', 'src/cache', 'tmp', 'keeptmp', 'builder'}
+
+
+def test_pruned_walk_archives_the_same_files(tmpdir):
+    source = str(tmpdir.mkdir('src'))
+    write_tree(source, dict((path, b'x') for path in PATHS if path not in ('docs', 'src/cache')))
+    matcher = ArchiveMatcher([], EXCLUDES)
+    expected = set()
+    for root, dirs, files in os.walk(source):
+        for name in files:
+            archive_name = os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/')
+            if matcher(archive_name):
+                expected.add(archive_name)
+
+    import zipfile
+    archive = create_archive(source, str(tmpdir.join('out.zip')), ignore_predicate=matcher)
+    with zipfile.ZipFile(archive) as zip_file:
+        assert set(zip_file.namelist()) == expected
+    assert not any(re.match(r'build/|node_modules/', name) for name in expected)
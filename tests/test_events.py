@@ -0,0 +1,44 @@
+from time import sleep
+
+from ebs_deploy import EventCursor
+
+from conftest import APP_NAME
+
+
+def add_events(simulator, env, count, prefix):
+    for i in range(count):
+        simulator.event(prefix + ' ' + str(i), env=simulator.environments[env])
+
+
+def test_event_cursor_follows_next_token(simulator, helper):
+    simulator.add_environment(APP_NAME, 'Test-Prod')
+    cursor = EventCursor(helper, start_time='2000-01-01T00:00:00Z')
+    add_events(simulator, 'Test-Prod', 250, 'first')
+
+    events = cursor.poll()
+    assert [event['Message'] for event in events] == ['first ' + str(i) for i in range(250)]
+    assert simulator.calls[('beanstalk', 'DescribeEvents')] == 3
+
+
+def test_event_cursor_dedupes(simulator, helper):
+    simulator.add_environment(APP_NAME, 'Test-Prod')
+    cursor = EventCursor(helper, start_time='2000-01-01T00:00:00Z')
+    add_events(simulator, 'Test-Prod', 5, 'first')
+    assert len(cursor.poll()) == 5
+
+    # the start time is inclusive, the newest event comes back
+    assert cursor.poll() == []
+
+    sleep(0.01)
+    add_events(simulator, 'Test-Prod', 3, 'second')
+    assert [event['Message'] for event in cursor.poll()] == ['second 0', 'second 1', 'second 2']
+    assert cursor.poll() == []
+
+
+def test_event_cursor_filters_environments(simulator, helper):
+    simulator.add_environment(APP_NAME, 'Test-Prod')
+    simulator.add_environment(APP_NAME, 'Test-Dev')
+    cursor = EventCursor(helper, environment_names=['Test-Prod'], start_time='2000-01-01T00:00:00Z')
+    add_events(simulator, 'Test-Dev', 2, 'dev')
+    add_events(simulator, 'Test-Prod', 2, 'prod')
+    assert [event['Message'] for event in cursor.poll()] == ['prod 0', 'prod 1']
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from ebs_deploy import Stage, run_stages
+
+
+def test_stages_get_required_results():
+    results = run_stages([
+        Stage('a', lambda results: 1),
+        Stage('b', lambda results: results['a'] + 1, requires=['a']),
+        Stage('c', lambda results: results['a'] + results['b'], requires=['a', 'b'])
+    ])
+    assert results == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_independent_stages_overlap():
+    # each waits for the other, so they only finish if they run at the same time
+    a_started = threading.Event()
+    b_started = threading.Event()
+
+    def a(results):
+        a_started.set()
+        assert b_started.wait(5)
+
+    def b(results):
+        b_started.set()
+        assert a_started.wait(5)
+
+    run_stages([Stage('a', a), Stage('b', b)])
+
+
+def test_failed_stage_stops_the_stages_that_need_it():
+    ran = []
+
+    def fail(results):
+        raise ValueError('failed')
+
+    def independent(results):
+        ran.append('independent')
+
+    with pytest.raises(ValueError):
+        run_stages([
+            Stage('fail', fail),
+            Stage('independent', independent),
+            Stage('after', lambda results: ran.append('after'), requires=['fail'])
+        ])
+    assert ran == ['independent']
+
+
+def test_running_stages_finish_before_the_error_is_raised():
+    finished = []
+    failed = threading.Event()
+
+    def fail(results):
+        failed.set()
+        raise ValueError('failed')
+
+    def slow(results):
+        failed.wait(5)
+        finished.append('slow')
+
+    with pytest.raises(ValueError):
+        run_stages([Stage('fail', fail), Stage('slow', slow), Stage('later', lambda results: None, requires=['slow'])])
+    assert finished == ['slow']
+
+
+def test_circular_requirements():
+    with pytest.raises(Exception) as e:
+        run_stages([
+            Stage('start', lambda results: None),
+            Stage('a', lambda results: None, requires=['start', 'b']),
+            Stage('b', lambda results: None, requires=['a'])
+        ])
+    assert 'circular' in str(e.value)
+
+
+def test_unknown_requirement():
+    with pytest.raises(Exception) as e:
+        run_stages([Stage('a', lambda results: None, requires=['missing'])])
+    assert 'unknown' in str(e.value)
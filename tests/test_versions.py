@@ -0,0 +1,48 @@
+from ebs_deploy import content_key
+
+from conftest import APP_NAME, BUCKET
+
+
+def add_versions(simulator, count):
+    """
+    Adds versions v0 (oldest) to v<count - 1> (newest)
+    """
+    for i in range(count):
+        simulator.add_version(APP_NAME, 'v' + str(i), BUCKET, 'test/v' + str(i) + '.zip')
+        simulator.versions[(APP_NAME, 'v' + str(i))]['DateCreated'] = 1500000000 + i
+        simulator.buckets[BUCKET]['keys']['test/v' + str(i) + '.zip'] = {'size': 1, 'etag': '"x"', 'metadata': {}}
+
+
+def labels(simulator):
+    return set(label for (app_name, label) in simulator.versions)
+
+
+def test_iter_versions_pages_through_every_version(simulator, helper):
+    add_versions(simulator, 1234)
+    versions = list(helper.iter_versions(page_size=100))
+    assert len(versions) == 1234
+    assert set(version.label for version in versions) == labels(simulator)
+    assert simulator.calls[('beanstalk', 'DescribeApplicationVersions')] == 13
+
+
+def test_gc_keeps_exactly_versions_to_keep(simulator, helper):
+    add_versions(simulator, 1200)
+    simulator.add_environment(APP_NAME, 'Test-Prod', version_label='v3')
+    helper.delete_unused_versions(versions_to_keep=5, workers=8, rate=10000)
+    assert labels(simulator) == set(['v3', 'v1195', 'v1196', 'v1197', 'v1198', 'v1199'])
+
+
+def test_gc_deletes_source_bundles_no_kept_version_uses(simulator, helper):
+    add_versions(simulator, 10)
+
+    # v0 (deleted) and v9 (kept) were built from the same content
+    shared = 'test/' + content_key('0' * 64)
+    simulator.buckets[BUCKET]['keys'][shared] = {'size': 1, 'etag': '"x"', 'metadata': {}}
+    for label in ('v0', 'v9'):
+        simulator.versions[(APP_NAME, label)]['SourceBundle']['S3Key'] = shared
+        del simulator.buckets[BUCKET]['keys']['test/' + label + '.zip']
+
+    helper.delete_unused_versions(versions_to_keep=5, delete_source_bundles=True, rate=10000)
+    assert labels(simulator) == set(['v5', 'v6', 'v7', 'v8', 'v9'])
+    assert set(simulator.buckets[BUCKET]['keys']) == \
+        set(['test/v5.zip', 'test/v6.zip', 'test/v7.zip', 'test/v8.zip', shared])